@@ -0,0 +1,108 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+from network.tiling import receptive_field
+
+
+def bucket_shape(height, width, buckets=None, step=64):
+    """
+    Pick the input shape an image is padded to.
+
+    :param int height: Image height
+    :param int width: Image width
+    :param list buckets: (height, width) shapes to choose from; the smallest by area that fits wins
+    :param int step: Shapes of images no bucket fits are rounded up to multiples of step
+    :return: (bucket_height, bucket_width)
+    """
+    if buckets:
+        fitting = [b for b in buckets if b[0] >= height and b[1] >= width]
+        if fitting:
+            return min(fitting, key=lambda b: (b[0] * b[1], b))
+    return int(math.ceil(height / step) * step), int(math.ceil(width / step) * step)
+
+
+def pad_to(img, shape, mode='edge'):
+    """Pad an (h, w, c) image at the bottom and right up to shape"""
+    return np.pad(img, ((0, shape[0] - img.shape[0]), (0, shape[1] - img.shape[1]), (0, 0)), mode=mode)
+
+
+class BucketedInference():
+    """
+    Run variable-size images through a fully convolutional model in a few fixed shapes.
+
+    Images are padded at the bottom and right to their size bucket, images of the same
+    bucket are predicted as one batch, and the outputs are cropped back. The model only
+    ever sees the bucket shapes, so graph and kernel setup happens once per bucket rather
+    than once per image size. Padded pixels only reach the output within the receptive
+    field of the bottom and right edges.
+    """
+
+    def __init__(self, model, buckets=None, step=64, batch_size=8, shrink=None, scale=None, mode='edge'):
+        """
+        :param model: Keras model or engine with a Keras-style predict method
+        :param list buckets: (height, width) input shapes; multiples of step if None
+        :param int step: Rounding of images that fit no bucket
+        :param int batch_size: Largest batch sent to the model
+        :param int shrink: Pixels lost per side to 'valid' padding; computed from the model if None
+        :param int scale: Up-scaling factor; computed from the model if None
+        :param str mode: numpy.pad mode of the padding
+        """
+        self.model = model
+        self.buckets = sorted(buckets) if buckets else None
+        self.step = step
+        self.batch_size = batch_size
+        self.mode = mode
+
+        if shrink is None or scale is None:
+            field = receptive_field(model)
+            shrink = field[1] if shrink is None else shrink
+            scale = field[2] if scale is None else scale
+        self.shrink = shrink
+        self.scale = scale
+
+        self.stats = OrderedDict()
+
+    def predict(self, imgs):
+        """
+        Upscale a list of images.
+
+        :param list imgs: Normalized (h, w, c) images of any sizes
+        :return: list of model outputs, in the order of imgs
+        """
+        groups = OrderedDict()
+        for i, img in enumerate(imgs):
+            groups.setdefault(bucket_shape(img.shape[0], img.shape[1], self.buckets, self.step), []).append(i)
+
+        s = self.scale
+        outputs = [None] * len(imgs)
+        for shape, indices in groups.items():
+            stat = self.stats.setdefault(shape, {'images': 0, 'batches': 0, 'pixels': 0, 'padded_pixels': 0})
+            for first in range(0, len(indices), self.batch_size):
+                group = indices[first:first + self.batch_size]
+                batch = np.empty((len(group), shape[0], shape[1], imgs[group[0]].shape[2]), dtype=np.float32)
+                for j, i in enumerate(group):
+                    batch[j] = pad_to(imgs[i], shape, self.mode)
+
+                pred = self.model.predict(batch, batch_size=len(group))
+                for j, i in enumerate(group):
+                    h, w = imgs[i].shape[:2]
+                    outputs[i] = pred[j, :(h - 2 * self.shrink) * s, :(w - 2 * self.shrink) * s]
+
+                stat['batches'] += 1
+                stat['images'] += len(group)
+                stat['pixels'] += len(group) * shape[0] * shape[1]
+                stat['padded_pixels'] += sum(shape[0] * shape[1] - imgs[i].shape[0] * imgs[i].shape[1] for i in group)
+        return outputs
+
+    def report(self):
+        """Images, batches and padding overhead (padded / processed pixels) of every bucket"""
+        return {
+            '{}x{}'.format(*shape): {
+                'images': stat['images'],
+                'batches': stat['batches'],
+                'padding_overhead': stat['padded_pixels'] / stat['pixels'] if stat['pixels'] else 0.0
+            }
+            for shape, stat in self.stats.items()
+        }
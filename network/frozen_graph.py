@@ -0,0 +1,89 @@
+import tensorflow as tf
+
+# TensorFlow 2 keeps the graph / session API under compat.v1
+tf1 = tf.compat.v1 if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1') else tf
+
+
+class FrozenGraph():
+    """
+    Run one of the frozen model/*.pb graphs in a single long-lived session.
+
+    The graph holds only constants and inference ops, so nothing is rebuilt or compiled
+    at start up. predict() matches the Keras model, so a FrozenGraph can stand in for
+    the Keras path, NumpySRCNN or be wrapped in TiledInference.
+    """
+
+    def __init__(self, path, input_name=None, output_name=None, intra_op_threads=0, inter_op_threads=0):
+        """
+        :param str path: Frozen GraphDef, e.g. ./model/yayoi_srcnn_935_2x.pb
+        :param str input_name: Input tensor; the only Placeholder if None
+        :param str output_name: Output tensor; the only node nothing else consumes if None
+        :param int intra_op_threads: Threads used inside one op. 0 lets TensorFlow decide
+        :param int inter_op_threads: Ops run concurrently. 0 lets TensorFlow decide
+        """
+        graph_def = tf1.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph_def = graph_def
+
+        self.input_name = input_name or self.find_input()
+        self.output_name = output_name or self.find_output()
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf1.import_graph_def(graph_def, name='')
+        self.input = self.graph.get_tensor_by_name(self.tensor_name(self.input_name))
+        self.output = self.graph.get_tensor_by_name(self.tensor_name(self.output_name))
+
+        config = tf1.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads,
+            inter_op_parallelism_threads=inter_op_threads
+        )
+        self.session = tf1.Session(graph=self.graph, config=config)
+
+    @staticmethod
+    def tensor_name(name):
+        return name if ':' in name else name + ':0'
+
+    def find_input(self):
+        inputs = [node.name for node in self.graph_def.node if node.op == 'Placeholder']
+        if len(inputs) != 1:
+            raise ValueError('Expected one Placeholder, found {}; pass input_name'.format(inputs))
+        return inputs[0]
+
+    def find_output(self):
+        consumed = set()
+        for node in self.graph_def.node:
+            for name in node.input:
+                consumed.add(name.lstrip('^').split(':')[0])
+        outputs = [node.name for node in self.graph_def.node if node.name not in consumed and node.op != 'Const']
+        if len(outputs) != 1:
+            raise ValueError('Expected one output node, found {}; pass output_name'.format(outputs))
+        return outputs[0]
+
+    def receptive_field(self):
+        """(halo, shrink, scale) of the graph's convolutions, for TiledInference"""
+        nodes = {node.name: node for node in self.graph_def.node}
+        radius = 0
+        shrink = 0
+        for node in self.graph_def.node:
+            if node.op != 'Conv2D':
+                continue
+            kernel = nodes[node.input[1].split(':')[0]]
+            while kernel.op != 'Const':
+                kernel = nodes[kernel.input[0].split(':')[0]]
+            size = kernel.attr['value'].tensor.tensor_shape.dim[0].size
+            radius += (size - 1) // 2
+            if node.attr['padding'].s == b'VALID':
+                shrink += (size - 1) // 2
+        return radius, shrink, 1
+
+    def predict(self, x, batch_size=None):
+        """
+        :param numpy.ndarray x: Input batch, as for the Keras model
+        :param batch_size: Ignored, for compatibility with the Keras predict signature
+        """
+        return self.session.run(self.output, feed_dict={self.input: x})
+
+    def close(self):
+        self.session.close()
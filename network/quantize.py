@@ -0,0 +1,251 @@
+import os
+import json
+import argparse
+
+import cv2
+import h5py
+import numpy as np
+
+from network.srcnn_numpy import NumpySRCNN, read_config, read_weights
+
+SIZE_CONV = 6
+INTERPOLATION = cv2.INTER_CUBIC
+
+
+def quantize_kernel(kernel, mode):
+    """
+    Reduce the precision of one convolution kernel.
+
+    :param numpy.ndarray kernel: (kh, kw, cin, cout) float32 kernel
+    :param str mode: 'float16', or 'int8' for symmetric per-output-channel quantization
+    :return: stored kernel and its per-channel scale (None for float16)
+    """
+    if mode == 'float16':
+        return kernel.astype(np.float16), None
+    amax = np.abs(kernel).reshape(-1, kernel.shape[-1]).max(axis=0)
+    scale = np.where(amax > 0, amax / 127., 1.).astype(np.float32)
+    return np.clip(np.round(kernel / scale), -127, 127).astype(np.int8), scale
+
+
+def dequantize_kernel(kernel, scale):
+    if scale is None:
+        return kernel.astype(np.float32)
+    return kernel.astype(np.float32) * scale
+
+
+def save_variant(path, weights, mode, act_scales=None):
+    """
+    Write a reduced-precision weight list as .npz. Only 4-d kernels are reduced, biases and
+    batch-norm parameters stay float32.
+
+    :param str path: Output file
+    :param list weights: Flat list of float32 weight arrays, as from model.get_weights()
+    :param str mode: 'float16' or 'int8'
+    :param list act_scales: Calibrated input scale of every convolution, stored for int8 inference
+    """
+    arrays = {'mode': np.array(mode)}
+    for i, w in enumerate(weights):
+        if w.ndim == 4:
+            q, scale = quantize_kernel(w, mode)
+            arrays['w{}'.format(i)] = q
+            if scale is not None:
+                arrays['s{}'.format(i)] = scale
+        else:
+            arrays['w{}'.format(i)] = w.astype(np.float32)
+    if act_scales is not None:
+        arrays['act_scales'] = np.array(act_scales, dtype=np.float32)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def load_variant(path):
+    """
+    Read a file written by save_variant.
+
+    Weights come back expanded to float32: neither NumPy nor Keras on the CPU has float16
+    or int8 convolution kernels that beat float32, so a variant saves file size and load
+    I/O, not runtime memory or compute.
+
+    :return: (float32 weight list, mode, activation scales or None)
+    """
+    with np.load(path) as data:
+        count = len([name for name in data.files if name.startswith('w')])
+        weights = []
+        for i in range(count):
+            scale = data['s{}'.format(i)] if 's{}'.format(i) in data.files else None
+            weights.append(dequantize_kernel(data['w{}'.format(i)], scale))
+        act_scales = data['act_scales'] if 'act_scales' in data.files else None
+        return weights, str(data['mode']), act_scales
+
+
+class QuantizedSRCNN(NumpySRCNN):
+    """
+    NumpySRCNN running a float16 or int8 weight variant.
+
+    Weights are stored reduced and expanded to float32 once at load, since NumPy has no
+    int8 or fast float16 GEMM; the model runs with float32 memory and speed. With simulate=True the input of every int8 layer is also rounded to its
+    calibrated 8-bit grid, so quality checks see int8 activation error as well.
+    """
+
+    def __init__(self, network_file, variant_file, threads=1, simulate=True):
+        """
+        :param str network_file: *_network.json of the float32 model
+        :param str variant_file: .npz written by save_variant
+        :param int threads: Threads sharing the row bands of every layer
+        :param bool simulate: Quantize activations of int8 variants to their calibrated range
+        """
+        with open(network_file, 'r') as f:
+            config = read_config(f.read())
+        weights, self.mode, act_scales = load_variant(variant_file)
+        self.setup(config, [weights[i:i + 2] for i in range(0, len(weights), 2)], threads)
+        self.act_scales = act_scales if simulate and self.mode == 'int8' else None
+
+    def predict(self, x, batch_size=None):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        for i, (kernel, bias, padding, relu) in enumerate(self.layers):
+            if self.act_scales is not None:
+                # Inputs are non-negative (image or ReLU output), so use the unsigned 8-bit grid
+                x = np.clip(np.round(x / self.act_scales[i]), 0, 255) * self.act_scales[i]
+            x = self.conv(x, kernel, bias, padding, relu)
+        return x
+
+
+def calibration_images(path, count=8):
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith(('.bmp', '.png', '.jpg', '.jpeg')))
+    return [os.path.join(path, name) for name in names[:count]]
+
+
+def evaluation_images(path, calibration):
+    """Images of path to run the PSNR gate on, leaving out those used for calibration"""
+    used = {os.path.realpath(name) for name in calibration}
+    names = [name for name in calibration_images(path, None) if os.path.realpath(name) not in used]
+    if not names:
+        raise ValueError('no held-out images to evaluate in ' + path)
+    return names
+
+
+def srcnn_sample(name, scale):
+    """Y channel of an image and its bicubic down/up-scaled network input"""
+    img = cv2.cvtColor(cv2.imread(name, cv2.IMREAD_COLOR), cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    shape = img.shape
+    lr = cv2.resize(img, (int(shape[1] / scale), int(shape[0] / scale)), interpolation=INTERPOLATION)
+    lr = cv2.resize(lr, (shape[1], shape[0]), interpolation=INTERPOLATION)
+    return img, lr.astype(np.float32)[None, :, :, None] / 255.
+
+
+def calibrate_srcnn(engine, names, scale, percentile=99.99):
+    """Input range of every convolution over the calibration images, as unsigned 8-bit scales"""
+    ranges = np.zeros(len(engine.layers), dtype=np.float32)
+    for name in names:
+        x = srcnn_sample(name, scale)[1]
+        for i, (kernel, bias, padding, relu) in enumerate(engine.layers):
+            ranges[i] = max(ranges[i], np.percentile(x, percentile))
+            x = engine.conv(x, kernel, bias, padding, relu)
+    return np.where(ranges > 0, ranges / 255., 1.)
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def srcnn_psnr(engine, names, scale):
+    """Mean Y-channel PSNR of an SRCNN engine over the area it predicts"""
+    values = []
+    for name in names:
+        hr, x = srcnn_sample(name, scale)
+        out = np.clip(engine.predict(x)[0, :, :, 0] * 255., 0, 255).round()
+        values.append(psnr(hr[SIZE_CONV:-SIZE_CONV, SIZE_CONV:-SIZE_CONV], out))
+    return float(np.mean(values))
+
+
+def srgan_psnr(generator, names, scale):
+    """Mean RGB PSNR of an SRGAN generator on bicubic-downscaled images"""
+    values = []
+    for name in names:
+        hr = cv2.cvtColor(cv2.imread(name, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        hr = hr[:hr.shape[0] // scale * scale, :hr.shape[1] // scale * scale]
+        lr = cv2.resize(hr, (hr.shape[1] // scale, hr.shape[0] // scale), interpolation=INTERPOLATION)
+        out = generator.predict(lr.astype(np.float32)[None] / 127.5 - 1)[0]
+        values.append(psnr(hr, np.clip(127.5 * out + 127.5, 0, 255).round()))
+    return float(np.mean(values))
+
+
+def gate(baseline, variant, max_drop):
+    """Report of the PSNR regression gate; passed is False when the variant loses more than max_drop dB"""
+    return {'baseline_psnr': baseline, 'variant_psnr': variant, 'drop': baseline - variant,
+            'max_drop': max_drop, 'passed': baseline - variant <= max_drop}
+
+
+def quantize_srcnn(network_file, weight_file, output, mode, calibrate, evaluate, scale=2, max_drop=0.1, count=8):
+    """
+    Write a float16 / int8 SRCNN variant and check it against the float32 model.
+
+    int8 activation ranges are calibrated on the first count images of calibrate, the
+    PSNR gate runs on the other images of evaluate. The variant file is removed again
+    when it fails the gate.
+    """
+    names = calibration_images(calibrate, count)
+    held_out = evaluation_images(evaluate, names)
+    engine = NumpySRCNN(network_file, weight_file)
+    with h5py.File(weight_file, 'r') as hf:
+        weights = [w for layer in read_weights(hf) for w in layer]
+
+    act_scales = calibrate_srcnn(engine, names, scale) if mode == 'int8' else None
+    save_variant(output, weights, mode, act_scales)
+
+    result = gate(srcnn_psnr(engine, held_out, scale), srcnn_psnr(QuantizedSRCNN(network_file, output), held_out, scale),
+                  max_drop)
+    if not result['passed']:
+        os.remove(output)
+    return result
+
+
+def quantize_srgan(weight_file, output, mode, evaluate, scale=4, max_drop=0.1):
+    """
+    Write a float16 / int8 weight variant of the SRGAN generator and gate it on the images of evaluate.
+
+    int8 is weight-only here: the generator runs in Keras, whose CPU convolutions are
+    float32, so activations are neither calibrated nor simulated and the gate only sees
+    the weight rounding error.
+    """
+    from network.srgan_deploy import SRGAN
+
+    names = evaluation_images(evaluate, [])
+    gan = SRGAN(upscaling_factor=scale, weights=weight_file)
+    weights = gan.generator.get_weights()
+    baseline = srgan_psnr(gan.generator, names, scale)
+
+    save_variant(output, weights, mode)
+    gan.generator.set_weights(load_variant(output)[0])
+
+    result = gate(baseline, srgan_psnr(gan.generator, names, scale), max_drop)
+    if not result['passed']:
+        os.remove(output)
+    return result
+
+
+# Produce and gate a reduced-precision model
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduced-precision SRCNN / SRGAN weights with a PSNR gate')
+    parser.add_argument('model', choices=['srcnn', 'srgan'])
+    parser.add_argument('--network', help='SRCNN *_network.json')
+    parser.add_argument('--weights', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--mode', choices=['float16', 'int8'], default='int8')
+    parser.add_argument('--scale', type=int, help='up-scaling factor, default 2 for srcnn and 4 for srgan')
+    parser.add_argument('--calibrate', default='./imageValidate/', help='int8 calibration images of srcnn')
+    parser.add_argument('--evaluate', default='./imageValidate2/', help='held-out images of the PSNR gate')
+    parser.add_argument('--count', type=int, default=8, help='number of calibration images')
+    parser.add_argument('--max-drop', type=float, default=0.1, help='largest accepted PSNR loss in dB')
+    args = parser.parse_args()
+
+    if args.model == 'srcnn':
+        result = quantize_srcnn(args.network, args.weights, args.output, args.mode, args.calibrate, args.evaluate,
+                                args.scale or 2, args.max_drop, args.count)
+    else:
+        result = quantize_srgan(args.weights, args.output, args.mode, args.evaluate, args.scale or 4, args.max_drop)
+    print(json.dumps(result, indent=2))
+    if not result['passed']:
+        raise SystemExit(args.output + ' rejected')
@@ -1,6 +1,8 @@
 from keras.models import Sequential
-from keras.layers import Conv2D, BatchNormalization
+from keras.layers import Conv2D, BatchNormalization, Lambda
 from keras.optimizers import Adam
+import cv2
+import numpy as np
 
 class srcnn:
   def __init__(self):
@@ -32,3 +34,66 @@ class srcnn:
     adam = Adam(lr=self.lr)
     network.compile(optimizer=adam, loss='mean_squared_error', metrics=['mean_squared_error'])
     return network
+
+
+def depth_to_space(x, scale):
+  import tensorflow as tf
+  return tf.nn.depth_to_space(x, scale)
+
+
+class srcnn_subpixel(srcnn):
+  """
+  SRCNN that runs on the low-resolution Y channel and upscales at the end with a
+  sub-pixel (depth-to-space) layer, as in ESPCN. Every convolution works on
+  1 / scale^2 of the pixels of the classic network.
+
+  All convolutions use 'same' padding. Training inputs are made by prepare() from the
+  HR labels of the existing h5 datasets with the cv2.resize bicubic downscale that
+  inference applies, so both see the same degradation.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.scale = 4
+    # LR size of the 52 x 52 labels of the default h5 datasets
+    self.inputShape = (13, 13, 1)
+
+  def network(self):
+    network = Sequential()
+
+    if (self.in_train):
+      inputShape = self.inputShape
+    else:
+      inputShape = (None, None, 1)
+
+    network.add(Conv2D(filters=self.filter[0], kernel_size = self.kernelSize[0], kernel_initializer='glorot_uniform',
+                       activation='relu', padding='same', use_bias=True, input_shape=inputShape))
+
+    for i in range(1, self.layers-1):
+      network.add(Conv2D(filters=self.filter[i], kernel_size = self.kernelSize[i], kernel_initializer='glorot_uniform',
+                         activation='relu', padding='same', use_bias=True))
+
+    network.add(Conv2D(filters=self.filter[self.layers-1] * self.scale ** 2, kernel_size = self.kernelSize[self.layers-1],
+                       kernel_initializer='glorot_uniform', activation='linear', padding='same', use_bias=True))
+    network.add(Lambda(depth_to_space, arguments={'scale': self.scale}, name='subpixel'))
+
+    adam = Adam(lr=self.lr)
+    network.compile(optimizer=adam, loss='mean_squared_error', metrics=['mean_squared_error'])
+    return network
+
+  def prepare(self, data, label):
+    """
+    Build the LR inputs of an h5 batch from its (N, H, W, 1) HR labels.
+
+    The labels are cropped to a multiple of scale and downscaled with cv2.resize, as
+    the images are at inference. The stored bicubic-upscaled inputs are not used.
+
+    :return: (LR inputs, cropped labels)
+    """
+    n, h, w, c = label.shape
+    h, w = h // self.scale * self.scale, w // self.scale * self.scale
+    label = label[:, :h, :w]
+    lr = np.empty((n, h // self.scale, w // self.scale, c), dtype=np.float32)
+    for i in range(n):
+      lr[i, :, :, 0] = cv2.resize(label[i, :, :, 0], (w // self.scale, h // self.scale), interpolation=cv2.INTER_CUBIC)
+    return lr, label
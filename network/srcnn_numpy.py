@@ -0,0 +1,145 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Largest im2col row (kernel height * width * input channels) before switching to
+# one GEMM per kernel offset, and the memory budget of one band's im2col buffer
+IM2COL_LIMIT = 512
+BAND_BYTES = 16 * 1024 * 1024
+
+
+def read_config(network_json):
+    """Return the Conv2D layer configs of a Keras Sequential model JSON"""
+    config = json.loads(network_json)['config']
+    if isinstance(config, dict):
+        config = config['layers']
+    layers = []
+    for layer in config:
+        if layer['class_name'] != 'Conv2D':
+            raise ValueError('Unsupported layer ' + layer['class_name'])
+        layer = layer['config']
+        if tuple(layer['strides']) != (1, 1) or tuple(layer['dilation_rate']) != (1, 1):
+            raise ValueError('Only stride 1, undilated convolutions are supported')
+        if layer['activation'] not in ('relu', 'linear'):
+            raise ValueError('Unsupported activation ' + layer['activation'])
+        layers.append(layer)
+    return layers
+
+
+def read_weights(group):
+    """Return [(kernel, bias), ...] in layer order from a Keras weight group"""
+    weights = []
+    for name in group.attrs['layer_names']:
+        layer = group[name]
+        values = [np.array(layer[weight], dtype=np.float32) for weight in layer.attrs['weight_names']]
+        if values:
+            weights.append(values)
+    return weights
+
+
+class NumpySRCNN():
+    """
+    Run a shipped SRCNN model with NumPy only, without importing Keras or TensorFlow.
+
+    Each convolution is a float32 GEMM, either on an im2col buffer or one per kernel
+    offset for wide layers, computed in bands of output rows that can be spread over
+    a thread pool. predict() matches the Keras model, so the engine also plugs into
+    TiledInference.
+    """
+
+    def __init__(self, network_file, weight_file, threads=1):
+        """
+        :param str network_file: *_network.json written by model.to_json()
+        :param str weight_file: *_weight.h5 written by model.save_weights()
+        :param int threads: Threads sharing the row bands of every layer
+        """
+        with open(network_file, 'r') as f:
+            config = read_config(f.read())
+        with h5py.File(weight_file, 'r') as hf:
+            weights = read_weights(hf)
+        self.setup(config, weights, threads)
+
+    @classmethod
+    def from_model(cls, model_file, threads=1):
+        """Load a *_model.h5 written by model.save(), which holds both architecture and weights"""
+        engine = cls.__new__(cls)
+        with h5py.File(model_file, 'r') as hf:
+            network_json = hf.attrs['model_config']
+            if isinstance(network_json, bytes):
+                network_json = network_json.decode()
+            engine.setup(read_config(network_json), read_weights(hf['model_weights']), threads)
+        return engine
+
+    def setup(self, config, weights, threads):
+        if len(config) != len(weights):
+            raise ValueError('Network has {} layers but weight file has {}'.format(len(config), len(weights)))
+        self.layers = []
+        for layer, (kernel, bias) in zip(config, weights):
+            self.layers.append((kernel, bias, layer['padding'], layer['activation'] == 'relu'))
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def receptive_field(self):
+        """(halo, shrink, scale) of the network, for TiledInference"""
+        radius = sum((kernel.shape[0] - 1) // 2 for kernel, _, _, _ in self.layers)
+        shrink = sum((kernel.shape[0] - 1) // 2 for kernel, _, padding, _ in self.layers if padding == 'valid')
+        return radius, shrink, 1
+
+    def conv_band(self, x, kernel, bias, relu, out, r0, r1):
+        """Compute output rows [r0, r1) of one convolution into out"""
+        n, _, _, cin = x.shape
+        kh, kw, _, cout = kernel.shape
+        rows, width = r1 - r0, out.shape[2]
+
+        if kh * kw * cin <= IM2COL_LIMIT:
+            s = x.strides
+            cols = as_strided(x[:, r0:], shape=(n, rows, width, kh, kw, cin),
+                              strides=(s[0], s[1], s[2], s[1], s[2], s[3]), writeable=False)
+            result = np.dot(cols.reshape(-1, kh * kw * cin), kernel.reshape(-1, cout))
+        else:
+            result = np.zeros((n * rows * width, cout), dtype=np.float32)
+            for dy in range(kh):
+                for dx in range(kw):
+                    tap = x[:, r0 + dy:r1 + dy, dx:dx + width, :].reshape(-1, cin)
+                    result += np.dot(tap, kernel[dy, dx])
+
+        result += bias
+        if relu:
+            np.maximum(result, 0, out=result)
+        out[:, r0:r1] = result.reshape(n, rows, width, cout)
+
+    def conv(self, x, kernel, bias, padding, relu):
+        kh, kw, cin, cout = kernel.shape
+        if padding == 'same':
+            x = np.pad(x, ((0, 0), ((kh - 1) // 2, kh // 2), ((kw - 1) // 2, kw // 2), (0, 0)), mode='constant')
+        n, h, w, _ = x.shape
+        out_h, out_w = h - kh + 1, w - kw + 1
+        out = np.empty((n, out_h, out_w, cout), dtype=np.float32)
+
+        # Bands small enough to bound the im2col buffer, and at least one per thread
+        row_bytes = n * out_w * max(kh * kw * cin, cout) * 4
+        band = max(1, min(BAND_BYTES // row_bytes, -(-out_h // self.threads)))
+        bands = [(r0, min(r0 + band, out_h)) for r0 in range(0, out_h, band)]
+
+        if self.pool is None:
+            for r0, r1 in bands:
+                self.conv_band(x, kernel, bias, relu, out, r0, r1)
+        else:
+            jobs = [self.pool.submit(self.conv_band, x, kernel, bias, relu, out, r0, r1) for r0, r1 in bands]
+            for job in jobs:
+                job.result()
+        return out
+
+    def predict(self, x, batch_size=None):
+        """
+        :param numpy.ndarray x: (n, height, width, 1) input in [0, 1]
+        :param batch_size: Ignored, for compatibility with the Keras predict signature
+        :return: (n, height - 2 * SIZE_CONV, width - 2 * SIZE_CONV, 1) float32 output
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        for kernel, bias, padding, relu in self.layers:
+            x = self.conv(x, kernel, bias, padding, relu)
+        return x
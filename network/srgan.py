@@ -1,13 +1,23 @@
 #! /usr/bin/python
 import os
-import pickle
+import time
+import csv
+import json
+import glob
+import shutil
 import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import h5py
 import numpy as np
 import imageio
 from scipy.misc import imresize
 import matplotlib.pyplot as plt
 
+import keras
+from keras import backend as K
 from keras.models import Sequential, Model
 from keras.layers import Input, Activation, Add
 from keras.layers import BatchNormalization, LeakyReLU, Conv2D, Dense
@@ -238,7 +248,10 @@ class SRGAN():
         batch_size=1,
         test_images=None, test_frequency=50, test_path="./images/samples/",
         weight_frequency=None, weight_path='./data/weights/',
-        print_frequency=1
+        print_frequency=1,
+        workers=0, prefetch=8, seed=None,
+        cache_path=None, feature_cache=None,
+        keep_checkpoints=3
     ):
         """Train the SRGAN network
 
@@ -251,7 +264,13 @@ class SRGAN():
         :param str test_path: where should test results be saved
         :param int weight_frequency: how often (in epochs) should network weights be saved. None for never
         :param int weight_path: where should network weights be saved
+        :param int keep_checkpoints: how many of the latest weight snapshots to keep on disk
         :param int print_frequency: how often (in epochs) to print progress to terminal
+        :param int workers: how many background workers prepare batches. 0 to load them on the training thread
+        :param int prefetch: how many batches the workers may prepare ahead
+        :param int seed: seed for the image sampling of the background workers
+        :param str cache_path: directory for the pre-resized image shards. None to decode images on every draw
+        :param str feature_cache: directory for cached VGG target features. None to run VGG on every step
         """
 
         # Create data loader
@@ -259,8 +278,16 @@ class SRGAN():
             datapath,
             self.height_hr, self.width_hr,
             self.height_lr, self.width_lr,
-            self.upscaling_factor
+            self.upscaling_factor,
+            cache_path
         )
+        features = None
+        if feature_cache:
+            features = FeatureCache(feature_cache, loader, self.vgg.output_shape[1:])
+
+        batches = loader
+        if workers:
+            batches = PrefetchLoader(loader, batch_size, workers, prefetch, seed)
 
         # Shape of output from discriminator
         disciminator_output_shape = list(self.discriminator.output_shape)
@@ -271,54 +298,200 @@ class SRGAN():
         real = np.ones(disciminator_output_shape)
         fake = np.ones(disciminator_output_shape)
 
-        # Each epoch == "update iteration" as defined in the paper
-        losses = []
-        for epoch in range(epochs):
+        # Losses are appended to a CSV and weights written from a background thread
+        os.makedirs(weight_path, exist_ok=True)
+        metrics = MetricsWriter(
+            os.path.join(weight_path, dataname + '_losses.csv'),
+            ['generator_' + name for name in self.srgan.metrics_names] +
+            ['discriminator_' + name for name in self.discriminator.metrics_names]
+        )
+        checkpoints = AsyncCheckpointer(os.path.join(weight_path, dataname), keep_checkpoints)
+
+        # Close the loss log, the checkpoint writer and the workers even when training fails
+        try:
+            # Each epoch == "update iteration" as defined in the paper
+            data_wait = 0.0
+            for epoch in range(epochs):
+
+                # Start epoch time
+                if epoch % (print_frequency + 1) == 0:
+                    start_epoch = datetime.datetime.now()
+
+                # Train discriminator
+                start_data = time.perf_counter()
+                imgs_hr, imgs_lr = batches.load_batch(batch_size)
+                data_wait += time.perf_counter() - start_data
+                generated_hr = self.generator.predict(imgs_lr)
+                real_loss = self.discriminator.train_on_batch(imgs_hr, real)
+                fake_loss = self.discriminator.train_on_batch(generated_hr, fake)
+                discriminator_loss = 0.5 * np.add(real_loss, fake_loss)
+
+                # Train generator
+                start_data = time.perf_counter()
+                imgs_hr, imgs_lr, img_paths = batches.load_batch(batch_size, return_paths=True)
+                data_wait += time.perf_counter() - start_data
+                if features:
+                    features_hr = features.predict(img_paths, imgs_hr, self.vgg)
+                else:
+                    features_hr = self.vgg.predict(imgs_hr)
+                generator_loss = self.srgan.train_on_batch([imgs_lr, imgs_hr], [real, features_hr])
+
+                # Save losses
+                metrics.write(epoch, list(generator_loss) + list(discriminator_loss))
+
+                # Plot the progress
+                if epoch % print_frequency == 0:
+                    print("Epoch {}/{} | Time: {}s | Data wait: {:.2f}s\n>> Generator: {}\n>> Discriminator: {}\n".format(
+                        epoch, epochs,
+                        (datetime.datetime.now() - start_epoch).seconds,
+                        data_wait,
+                        ", ".join(["{}={:.3e}".format(k, v) for k, v in zip(self.srgan.metrics_names, generator_loss)]),
+                        ", ".join(["{}={:.3e}".format(k, v) for k, v in zip(self.discriminator.metrics_names, discriminator_loss)])
+                    ))
+
+                # If test images are supplied, show them to the user
+                if test_images and epoch % test_frequency == 0:
+                    plot_test_images(self, loader, test_images, test_path, epoch)
+
+                # Check if we should save the network weights
+                if weight_frequency and epoch % weight_frequency == 0:
+
+                    # Snapshot the network weights, written in the background
+                    checkpoints.save(epoch, {'generator': self.generator, 'discriminator': self.discriminator})
+                    if features:
+                        features.flush()
+
+                    # Flush the recorded losses
+                    metrics.flush()
+        finally:
+            if workers:
+                batches.close()
+            metrics.close()
+            checkpoints.close()
+
+
+def snapshot_layers(model):
+    """Copy of the weights of every layer, with the names model.save_weights would store"""
+    layers = []
+    for layer in model.layers:
+        values = layer.get_weights()
+        names = [getattr(w, 'name', 'param_{}'.format(i)) for i, w in enumerate(layer.weights)]
+        layers.append((layer.name, names, values))
+    return layers
+
+
+def write_weight_file(filepath, layers):
+    """Write a snapshot_layers copy in the h5 layout of model.save_weights"""
+    with h5py.File(filepath, 'w') as f:
+        f.attrs['layer_names'] = np.array([name.encode('utf8') for name, _, _ in layers], dtype='S')
+        f.attrs['backend'] = np.bytes_(K.backend())
+        f.attrs['keras_version'] = np.bytes_(str(keras.__version__))
+        for name, weight_names, values in layers:
+            group = f.create_group(name)
+            group.attrs['weight_names'] = np.array([n.encode('utf8') for n in weight_names], dtype='S')
+            for weight_name, value in zip(weight_names, values):
+                dataset = group.create_dataset(weight_name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+
+
+class MetricsWriter():
+    """Append one CSV row per epoch, so saving the history never rewrites what is already on disk"""
+
+    def __init__(self, filepath, names):
+        """
+        :param str filepath: CSV file, appended to if it exists
+        :param list names: metric names, one column each after the epoch
+        """
+        exists = os.path.exists(filepath) and os.path.getsize(filepath) > 0
+        self.file = open(filepath, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if not exists:
+            self.writer.writerow(['epoch', 'time'] + list(names))
 
-            # Start epoch time
-            if epoch % (print_frequency + 1) == 0:
-                start_epoch = datetime.datetime.now()
+    def write(self, epoch, values):
+        self.writer.writerow([epoch, '{:.3f}'.format(time.time())] + ['{:.6e}'.format(v) for v in values])
 
-            # Train discriminator
-            imgs_hr, imgs_lr = loader.load_batch(batch_size)
-            generated_hr = self.generator.predict(imgs_lr)
-            real_loss = self.discriminator.train_on_batch(imgs_hr, real)
-            fake_loss = self.discriminator.train_on_batch(generated_hr, fake)
-            discriminator_loss = 0.5 * np.add(real_loss, fake_loss)
+    def flush(self):
+        self.file.flush()
 
-            # Train generator
-            imgs_hr, imgs_lr = loader.load_batch(batch_size)
-            features_hr = self.vgg.predict(imgs_hr)
-            generator_loss = self.srgan.train_on_batch([imgs_lr, imgs_hr], [real, features_hr])
+    def close(self):
+        self.file.close()
 
-            # Save losses
-            losses.append({'generator': generator_loss, 'discriminator': discriminator_loss})
 
-            # Plot the progress
-            if epoch % print_frequency == 0:
-                print("Epoch {}/{} | Time: {}s\n>> Generator: {}\n>> Discriminator: {}\n".format(
-                    epoch, epochs,
-                    (datetime.datetime.now() - start_epoch).seconds,
-                    ", ".join(["{}={:.3e}".format(k, v) for k, v in zip(self.srgan.metrics_names, generator_loss)]),
-                    ", ".join(["{}={:.3e}".format(k, v) for k, v in zip(self.discriminator.metrics_names, discriminator_loss)])
-                ))
+class AsyncCheckpointer():
+    """
+    Write network weights from a background thread.
 
-            # If test images are supplied, show them to the user
-            if test_images and epoch % test_frequency == 0:
-                plot_test_images(self, loader, test_images, test_path, epoch)
+    save() only copies the weights into memory; the files are written by a worker
+    thread to a temporary name and renamed into place, and only the latest keep
+    snapshots are left on disk. Every save also replaces <prefix>_<network>.h5, the
+    stable name that loading code picks up. A new snapshot waits for the previous write only when
+    the disk can not keep up with the checkpoint frequency.
 
-            # Check if we should save the network weights
-            if weight_frequency and epoch % weight_frequency == 0:
+    Snapshots use the h5 layout of model.save_weights, so they load anywhere Keras
+    weights do (srgan_deploy, the upscale service, quantize, benchmark).
+    """
 
-                # Save the network weights
-                self.save_weights(os.path.join(weight_path, dataname))
+    def __init__(self, filepath, keep=3):
+        """
+        :param str filepath: path prefix, snapshots are named <prefix>_epoch<N>_<network>.h5 and the
+            latest is also written to <prefix>_<network>.h5
+        :param int keep: number of snapshots to keep. None to keep all of them
+        """
+        self.filepath = filepath
+        self.keep = keep
+        self.thread = None
+        self.error = None
 
-                # Save the recorded losses
-                pickle.dump(losses, open(os.path.join(weight_path, dataname+'_losses.p'), 'wb'))
+    def save(self, epoch, models):
+        """
+        :param int epoch: epoch number used in the file names
+        :param dict models: network name -> Keras model
+        """
+        snapshot = {name: snapshot_layers(model) for name, model in models.items()}
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(epoch, snapshot), daemon=True)
+        self.thread.start()
+
+    def write(self, epoch, snapshot):
+        try:
+            for name, layers in snapshot.items():
+                filepath = "{}_epoch{}_{}.h5".format(self.filepath, epoch, name)
+                write_weight_file(filepath + '.tmp', layers)
+                os.replace(filepath + '.tmp', filepath)
+                latest = "{}_{}.h5".format(self.filepath, name)
+                shutil.copyfile(filepath, latest + '.tmp')
+                os.replace(latest + '.tmp', latest)
+            self.prune(list(snapshot))
+        except Exception as e:
+            self.error = e
+
+    def prune(self, names):
+        if not self.keep:
+            return
+        for name in names:
+            files = glob.glob("{}_epoch*_{}.h5".format(glob.escape(self.filepath), name))
+            files.sort(key=lambda f: int(f[len(self.filepath) + 6:-len(name) - 4]))
+            for filepath in files[:-self.keep]:
+                os.remove(filepath)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.wait()
 
 
 class DataLoader():
-    def __init__(self, datapath, height_hr, width_hr, height_lr, width_lr, scale):
+    def __init__(self, datapath, height_hr, width_hr, height_lr, width_lr, scale, cache_path=None, shard_size=1024):
         """
         :param string datapath: filepath to training images
         :param int height_hr: Height of high-resolution images
@@ -326,6 +499,8 @@ class DataLoader():
         :param int height_hr: Height of low-resolution images
         :param int width_hr: Width of low-resolution images
         :param int scale: Upscaling factor
+        :param string cache_path: directory of pre-resized uint8 shards used for training batches. None to decode every time
+        :param int shard_size: images per shard file when building the cache
         """
 
         # Store the datapath
@@ -343,40 +518,153 @@ class DataLoader():
                 self.img_paths.append(os.path.join(dirpath, filename))
         print(f">> Found {len(self.img_paths)} images in dataset")
 
-    def get_random_images(self, n_imgs=1):
+        # Pre-resized training pairs, memory-mapped on first use
+        self.cache_path = cache_path
+        self.shard_size = shard_size
+        self.cache_index = None
+        self.shards = None
+        if cache_path:
+            self.cache_index = self.open_cache()
+
+    def __getstate__(self):
+        # Worker processes map the shards themselves instead of receiving a copy
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def cache_key(self):
+        """What the cache must match: output shapes and the size / mtime of every source image"""
+        files = {}
+        for img_path in self.img_paths:
+            stat = os.stat(img_path)
+            files[img_path] = [stat.st_size, int(stat.st_mtime)]
+        return {
+            'shape_hr': [self.height_hr, self.width_hr],
+            'shape_lr': [self.height_lr, self.width_lr],
+            'files': files
+        }
+
+    def open_cache(self):
+        """Load the shard index, building the shards first if they are missing or stale"""
+        key = self.cache_key()
+        index_file = os.path.join(self.cache_path, 'index.json')
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            if index['key'] == key:
+                return index
+        return self.build_cache(key)
+
+    def build_cache(self, key=None):
+        """
+        Decode and resize every image once into uint8 shard files.
+
+        :param dict key: result of cache_key(), recorded in the index
+        :return: the shard index
+        """
+        key = key or self.cache_key()
+        os.makedirs(self.cache_path, exist_ok=True)
+        paths = sorted(key['files'])
+
+        print(f">> Caching {len(paths)} images in {self.cache_path}")
+        shards = []
+        for first in range(0, len(paths), self.shard_size):
+            chunk = paths[first:first + self.shard_size]
+            name = 'shard_{:05d}'.format(len(shards))
+            hr = np.lib.format.open_memmap(os.path.join(self.cache_path, name + '_hr.npy'), mode='w+',
+                                           dtype=np.uint8, shape=(len(chunk), self.height_hr, self.width_hr, 3))
+            lr = np.lib.format.open_memmap(os.path.join(self.cache_path, name + '_lr.npy'), mode='w+',
+                                           dtype=np.uint8, shape=(len(chunk), self.height_lr, self.width_lr, 3))
+            for i, img_path in enumerate(chunk):
+                hr[i], lr[i] = self.load_pair(img_path)
+            hr.flush()
+            lr.flush()
+            del hr, lr
+            shards.append(name)
+
+        # The index is written last, so an interrupted build is simply redone
+        index = {'key': key, 'paths': paths, 'shards': shards, 'shard_size': self.shard_size}
+        tmp_file = os.path.join(self.cache_path, 'index.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, os.path.join(self.cache_path, 'index.json'))
+        return index
+
+    def open_shards(self):
+        if self.shards is None:
+            self.shards = [
+                (np.load(os.path.join(self.cache_path, name + '_hr.npy'), mmap_mode='r'),
+                 np.load(os.path.join(self.cache_path, name + '_lr.npy'), mmap_mode='r'))
+                for name in self.cache_index['shards']
+            ]
+        return self.shards
+
+    def load_cached_batch(self, batch_size=1, rng=None, return_paths=False):
+        """Draw a random training batch from the shard cache, scaling only the selected images"""
+        rng = rng or np.random
+        shards = self.open_shards()
+        indices = rng.randint(0, len(self.cache_index['paths']), size=batch_size)
+
+        imgs_hr = np.empty((batch_size, self.height_hr, self.width_hr, 3), dtype=np.float32)
+        imgs_lr = np.empty((batch_size, self.height_lr, self.width_lr, 3), dtype=np.float32)
+        for i, index in enumerate(indices):
+            hr, lr = shards[index // self.cache_index['shard_size']]
+            imgs_hr[i] = hr[index % self.cache_index['shard_size']]
+            imgs_lr[i] = lr[index % self.cache_index['shard_size']]
+        imgs_hr /= 127.5
+        imgs_hr -= 1
+        imgs_lr /= 127.5
+        imgs_lr -= 1
+        if return_paths:
+            return imgs_hr, imgs_lr, [self.cache_index['paths'][index] for index in indices]
+        return imgs_hr, imgs_lr
+
+    def get_random_images(self, n_imgs=1, rng=None):
         """Get n_imgs random images from the dataset"""
-        return np.random.choice(self.img_paths, size=n_imgs)
+        rng = rng or np.random
+        return rng.choice(self.img_paths, size=n_imgs)
 
     def scale_imgs(self, imgs):
         """Scale images prior to passing to SRGAN"""
-        return imgs / 127.5 - 1
+        return imgs.astype(np.float32) / 127.5 - 1
+
+    def load_pair(self, img_path, training=True):
+        """Decode one image and resize it into its unscaled (hr, lr) pair"""
+
+        # Load image
+        img = imageio.imread(img_path).astype(np.float)
 
-    def load_batch(self, batch_size=1, img_paths=None, training=True):
+        # If gray-scale, convert to RGB
+        if len(img.shape) == 2:
+            img = np.stack((img,)*3, -1)
+
+        # Resize images appropriately
+        if training:
+            img_hr = imresize(img, (self.height_hr, self.width_hr))
+            img_lr = imresize(img, (self.height_lr, self.width_lr))
+        else:
+            lr_shape = (int(img.shape[0]/self.scale), int(img.shape[1]/self.scale))
+            img_hr = np.array(img)
+            img_lr = imresize(img, lr_shape)
+        return img_hr, img_lr
+
+    def load_batch(self, batch_size=1, img_paths=None, training=True, rng=None, return_paths=False):
         """Loads a batch of images from datapath folder"""
 
+        # Random training batches come straight from the shard cache when there is one
+        if not img_paths and training and self.cache_index:
+            return self.load_cached_batch(batch_size, rng, return_paths)
+
         # Pick a random set of images from the datapath if not already set
         if not img_paths:
-            img_paths = self.get_random_images(batch_size)
+            img_paths = self.get_random_images(batch_size, rng)
 
         # Scale and pre-process images
         imgs_hr, imgs_lr = [], []
         for img_path in img_paths:
 
             # Load image
-            img = imageio.imread(img_path).astype(np.float)
-
-            # If gray-scale, convert to RGB
-            if len(img.shape) == 2:
-                img = np.stack((img,)*3, -1)
-
-            # Resize images appropriately
-            if training:
-                img_hr = imresize(img, (self.height_hr, self.width_hr))
-                img_lr = imresize(img, (self.height_lr, self.width_lr))
-            else:
-                lr_shape = (int(img.shape[0]/self.scale), int(img.shape[1]/self.scale))
-                img_hr = np.array(img)
-                img_lr = imresize(img, lr_shape)
+            img_hr, img_lr = self.load_pair(img_path, training)
 
             # For prototyping
             # print(f">> Reading image: {img_path}")
@@ -392,9 +680,167 @@ class DataLoader():
             imgs_lr = np.array(imgs_lr)
 
         # Return image batch
+        if return_paths:
+            return imgs_hr, imgs_lr, list(img_paths)
         return imgs_hr, imgs_lr
 
 
+# DataLoader of a PrefetchLoader worker process, set once by init_prefetch_worker
+worker_loader = None
+
+
+def init_prefetch_worker(loader):
+    global worker_loader
+    worker_loader = loader
+
+
+def load_seeded_batch(batch_size, seed, loader=None):
+    """
+    Worker task of PrefetchLoader. Every batch gets its own RandomState so workers never share a sequence.
+
+    :param DataLoader loader: loader of a thread worker. None in worker processes, which use worker_loader
+    """
+    loader = loader or worker_loader
+    return loader.load_batch(batch_size, rng=np.random.RandomState(seed), return_paths=True)
+
+
+class PrefetchLoader():
+    """
+    Prepare training batches of a DataLoader in background workers.
+
+    Up to prefetch batches are decoded and resized ahead of the training loop. Batch i
+    is drawn with seed + i, so a seeded run gives the same batches whatever the number
+    of workers, and they are handed out in submission order.
+    """
+
+    def __init__(self, loader, batch_size, workers=2, prefetch=8, seed=None, processes=False):
+        """
+        :param DataLoader loader: Loader doing the actual decoding and resizing
+        :param int batch_size: Images per batch
+        :param int workers: Number of background threads or processes
+        :param int prefetch: Upper bound on batches prepared ahead of use
+        :param int seed: Base seed of the sampling. None for a fresh random state per batch
+        :param bool processes: Use a process pool instead of threads
+        """
+        self.loader = loader
+        self.batch_size = batch_size
+        self.seed = seed
+        if processes:
+            # The loader is sent to each process once; tasks only carry the batch size and seed
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_prefetch_worker, initargs=(loader,))
+            self.task_loader = None
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            self.task_loader = loader
+
+        # Time the training loop spent blocked on data
+        self.wait_time = 0.0
+        self.batches = 0
+
+        self.submitted = 0
+        self.futures = deque()
+        for _ in range(prefetch):
+            self.submit()
+
+    def submit(self):
+        seed = None if self.seed is None else self.seed + self.submitted
+        self.futures.append(self.executor.submit(load_seeded_batch, self.batch_size, seed, self.task_loader))
+        self.submitted += 1
+
+    def load_batch(self, batch_size=None, return_paths=False):
+        """Return the next prepared (imgs_hr, imgs_lr) batch and queue another one"""
+        start = time.perf_counter()
+        batch = self.futures.popleft().result()
+        self.wait_time += time.perf_counter() - start
+        self.batches += 1
+        self.submit()
+        return batch if return_paths else batch[:2]
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+class FeatureCache():
+    """
+    Memory-mapped store of VGG19 target features for the training images.
+
+    In training mode the HR image of a file is always the same resize, so its features
+    only need computing once. Rows are keyed by image path inside a directory named
+    after the HR shape, and are filled lazily or by precompute(). Each image takes
+    prod(feature_shape) values, e.g. 4 MB in float32 for 256x256 HR images.
+    """
+
+    def __init__(self, cache_path, loader, feature_shape, dtype=np.float32):
+        """
+        :param str cache_path: directory for the cache files
+        :param DataLoader loader: loader whose images are cached, fixing the key set and HR shape
+        :param tuple feature_shape: shape of one VGG output, without the batch axis
+        :param dtype: storage type of the features, np.float16 halves the disk use
+        """
+        self.path = os.path.join(cache_path, 'vgg_{}x{}'.format(loader.height_hr, loader.width_hr))
+        os.makedirs(self.path, exist_ok=True)
+
+        key = loader.cache_key()
+        paths = sorted(key['files'])
+        self.rows = {img_path: row for row, img_path in enumerate(paths)}
+
+        # Start over when the images or the feature layout changed
+        key['feature_shape'] = list(feature_shape)
+        key['dtype'] = np.dtype(dtype).name
+        key_file = os.path.join(self.path, 'key.json')
+        fresh = True
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                fresh = json.load(f) != key
+
+        mode = 'w+' if fresh else 'r+'
+        self.features = np.lib.format.open_memmap(os.path.join(self.path, 'features.npy'), mode=mode,
+                                                  dtype=dtype, shape=(len(paths),) + tuple(feature_shape))
+        self.filled = np.lib.format.open_memmap(os.path.join(self.path, 'filled.npy'), mode=mode,
+                                                dtype=np.bool_, shape=(len(paths),))
+        if fresh:
+            with open(key_file, 'w') as f:
+                json.dump(key, f)
+
+        self.hits = 0
+        self.misses = 0
+
+    def predict(self, img_paths, imgs_hr, vgg):
+        """
+        Return the VGG features of a batch, running the network only for images not cached yet.
+
+        :param list img_paths: source path of each image of the batch
+        :param numpy.ndarray imgs_hr: the scaled HR batch
+        :param vgg: the VGG feature model
+        :return: float32 features for the batch
+        """
+        rows = np.array([self.rows[img_path] for img_path in img_paths])
+        missing = ~self.filled[rows]
+        if missing.any():
+            # Duplicates in a batch are computed once
+            new_rows, first = np.unique(rows[missing], return_index=True)
+            self.features[new_rows] = vgg.predict(imgs_hr[missing][first])
+            self.filled[new_rows] = True
+        self.misses += int(missing.sum())
+        self.hits += int(len(rows) - missing.sum())
+        return self.features[rows].astype(np.float32)
+
+    def precompute(self, loader, vgg, batch_size=16):
+        """Fill every row that is still missing"""
+        paths = [img_path for img_path, row in sorted(self.rows.items(), key=lambda item: item[1]) if not self.filled[row]]
+        for first in range(0, len(paths), batch_size):
+            img_paths = paths[first:first + batch_size]
+            imgs_hr, _ = loader.load_batch(img_paths=img_paths)
+            self.predict(img_paths, imgs_hr, vgg)
+        self.flush()
+
+    def flush(self):
+        self.features.flush()
+        self.filled.flush()
+
+
 def plot_test_images(model, loader, test_images, test_output, epoch):
     """
     :param SRGAN model: The trained SRGAN model
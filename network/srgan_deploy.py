@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 
 from keras.models import Sequential, Model
@@ -7,7 +9,8 @@ from keras.layers import UpSampling2D
 from keras.optimizers import Adam
 
 class SRGAN():
-    def __init__(self, height_lr=64, width_lr=64, channels=3, upscaling_factor=4, gen_lr=1e-4):
+    def __init__(self, height_lr=64, width_lr=64, channels=3, upscaling_factor=4, gen_lr=1e-4, weights='imagenet_generator.h5',
+                 fused=False, exact=True, variant=None):
         """
         :param int height_lr: Height of low-resolution images
         :param int width_lr: Width of low-resolution images
@@ -16,6 +19,11 @@ class SRGAN():
         :param int gen_lr: Learning rate of generator
         :param int dis_lr: Learning rate of discriminator
         :param int gan_lr: Learning rate of GAN
+        :param str weights: Path of the generator weights to load
+        :param bool fused: Build the inference-only generator with BatchNormalization folded into the convolutions
+        :param bool exact: When fused, keep the batch norms that follow a ReLU, see fold_batchnorm
+        :param str variant: Load this float16 / int8 weight variant written by quantize_srgan instead of weights.
+            Its weights are expanded to float32, so the generator runs with float32 memory and speed
         """
 
         # Low-resolution image dimensions
@@ -34,26 +42,66 @@ class SRGAN():
         self.shape_lr = (self.height_lr, self.width_lr, self.channels)
         self.shape_hr = (self.height_hr, self.width_hr, self.channels)
 
-        optimizer_generator = Adam(gen_lr, 0.9)
-        self.generator = self.build_generator(optimizer_generator)
-        self.generator.load_weights('imagenet_generator.h5')
+        if variant:
+            from network.quantize import load_variant
+            self.generator = self.build_generator(None)
+            self.generator.set_weights(load_variant(variant)[0])
+        elif fused:
+            self.generator = self.build_fused_generator(weights, exact)
+        else:
+            optimizer_generator = Adam(gen_lr, 0.9)
+            self.generator = self.build_generator(optimizer_generator)
+            self.generator.load_weights(weights)
+
+
+    def build_fused_generator(self, weights, exact=True):
+        """
+        Build the generator for inference only: no optimizer, no compile and no batch norm
+        after a convolution.
 
+        The folded weights are stored next to the h5 file, so later starts skip building
+        the training graph altogether.
 
-    def build_generator(self, optimizer, residual_blocks=16):
+        :param str weights: Path of the trained generator weights
+        :param bool exact: Keep the batch norms that follow a ReLU
+        :return: the fused model
+        """
+        model = self.build_generator(None, conv_bn=False, act_bn=exact)
+
+        cache = '{}.fused{}.npz'.format(os.path.splitext(weights)[0], '' if exact else '_all')
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(weights):
+            with np.load(cache) as data:
+                model.set_weights([data['arr_{}'.format(i)] for i in range(len(data.files))])
+            return model
+
+        trained = self.build_generator(None)
+        trained.load_weights(weights)
+        model.set_weights(fold_batchnorm(trained, exact))
+        with open(cache + '.tmp', 'wb') as f:
+            np.savez(f, *model.get_weights())
+        os.replace(cache + '.tmp', cache)
+        return model
+
+
+    def build_generator(self, optimizer, residual_blocks=16, conv_bn=True, act_bn=True):
         """
         Build the generator network according to description in the paper.
 
-        :param optimizer: Keras optimizer to use for network
+        :param optimizer: Keras optimizer to use for network. None to skip compiling
         :param int residual_blocks: How many residual blocks to use
+        :param bool conv_bn: Add the batch norms that follow a convolution
+        :param bool act_bn: Add the batch norms that follow a ReLU
         :return: the compiled model
         """
 
         def residual_block(input):
             x = Conv2D(64, kernel_size=3, strides=1, padding='same')(input)
             x = Activation('relu')(x)
-            x = BatchNormalization(momentum=0.8)(x)
+            if act_bn:
+                x = BatchNormalization(momentum=0.8)(x)
             x = Conv2D(64, kernel_size=3, strides=1, padding='same')(x)
-            x = BatchNormalization(momentum=0.8)(x)
+            if conv_bn:
+                x = BatchNormalization(momentum=0.8)(x)
             x = Add()([x, input])
             return x
 
@@ -77,7 +125,8 @@ class SRGAN():
 
         # Post-residual block
         x = Conv2D(64, kernel_size=3, strides=1, padding='same')(r)
-        x = BatchNormalization(momentum=0.8)(x)
+        if conv_bn:
+            x = BatchNormalization(momentum=0.8)(x)
         x = Add()([x, x_start])
 
         # Upsampling (if 4; run twice, if 8; run thrice, etc.)
@@ -89,8 +138,54 @@ class SRGAN():
 
         # Create model and compile
         model = Model(inputs=lr_input, outputs=hr_output)
-        model.compile(
-            loss='binary_crossentropy',
-            optimizer=optimizer
-        )
+        if optimizer is not None:
+            model.compile(
+                loss='binary_crossentropy',
+                optimizer=optimizer
+            )
         return model
+
+
+def fold_batchnorm(model, exact=True):
+    """
+    Fold the inference-time batch norms of a trained generator into its convolutions.
+
+    A batch norm straight after a convolution becomes a per-output-channel scale of the
+    kernel and a new bias, which is exact. A batch norm after a ReLU can only be pushed
+    into the input channels of the next convolution; its shift then also reaches the
+    zero padding, so the one-pixel frame of that layer changes slightly. With exact=True
+    those batch norms are kept as they are.
+
+    :param model: generator built by build_generator with both kinds of batch norm
+    :param bool exact: Keep the batch norms that follow a ReLU
+    :return: weight list for build_generator(None, conv_bn=False, act_bn=exact)
+    """
+    weights = []
+    convs = []
+    pending = None
+    previous = None
+    for layer in model.layers:
+        name = layer.__class__.__name__
+        if name == 'Conv2D':
+            kernel, bias = layer.get_weights()
+            if pending is not None:
+                scale, shift = pending
+                bias = bias + np.einsum('hwio,i->o', kernel, shift)
+                kernel = kernel * scale[None, None, :, None]
+                pending = None
+            entry = [kernel, bias]
+            convs.append(entry)
+            weights.append(entry)
+        elif name == 'BatchNormalization':
+            gamma, beta, mean, variance = layer.get_weights()
+            scale = gamma / np.sqrt(variance + layer.epsilon)
+            shift = beta - mean * scale
+            if previous == 'Conv2D':
+                convs[-1][0] = convs[-1][0] * scale
+                convs[-1][1] = convs[-1][1] * scale + shift
+            elif exact:
+                weights.append([gamma, beta, mean, variance])
+            else:
+                pending = (scale, shift)
+        previous = name
+    return [w for entry in weights for w in entry]
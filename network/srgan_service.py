@@ -0,0 +1,275 @@
+import json
+import queue
+import threading
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from network.bucketing import bucket_shape
+from utility.resultCache import ResultCache, modelIdentity, resultKey
+
+
+class BatchScheduler():
+    """
+    Coalesce concurrent upscale requests into batches for a single model.
+
+    Requests that arrive within max_latency seconds of the first one are grouped together.
+    Images of the same shape share a batch; with pad=True every image of the window is
+    edge-padded to a common shape and run as one batch, then cropped back. With bucket set,
+    images are grouped by their size bucket and padded to it, so the generator only sees
+    a few input shapes.
+    """
+
+    def __init__(self, predict, scale, max_batch=8, max_latency=0.01, pad=False, bucket=None):
+        """
+        :param predict: Callable mapping a (n, h, w, c) batch to the model output
+        :param int scale: Up-scaling factor of the model, used to crop padded outputs
+        :param int max_batch: Largest number of images sent to the model at once
+        :param float max_latency: How long (in seconds) to wait for a batch to fill up
+        :param bool pad: Pad images of different shapes into a single batch
+        :param int bucket: Pad images up to multiples of bucket pixels and batch by padded shape
+        """
+        self.predict = predict
+        self.scale = scale
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pad = pad
+        self.bucket = bucket
+
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.served = 0
+        self.padded_pixels = 0
+        self.total_pixels = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, img):
+        """Queue one normalized (h, w, c) image and return a Future for its output"""
+        future = Future()
+        self.requests.put((img, future))
+        return future
+
+    def collect(self):
+        """Block for the first request, then gather more until the batch is full or the window closes"""
+        pending = [self.requests.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def run(self):
+        while True:
+            pending = self.collect()
+            if self.pad:
+                groups = [pending]
+            else:
+                shapes = {}
+                for item in pending:
+                    shapes.setdefault(self.batch_shape(item[0]), []).append(item)
+                groups = list(shapes.values())
+
+            for group in groups:
+                try:
+                    outputs = self.run_batch([img for img, _ in group], self.bucket_shape(group[0][0]))
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, future), output in zip(group, outputs):
+                    future.set_result(output)
+
+    def bucket_shape(self, img):
+        if self.bucket is None:
+            return None
+        return bucket_shape(img.shape[0], img.shape[1], step=self.bucket)
+
+    def batch_shape(self, img):
+        return self.bucket_shape(img) or img.shape
+
+    def run_batch(self, imgs, shape=None):
+        """Pad the images to shape (or their common shape) if needed, predict and crop the outputs back"""
+        height = max([img.shape[0] for img in imgs] + ([shape[0]] if shape else []))
+        width = max([img.shape[1] for img in imgs] + ([shape[1]] if shape else []))
+        batch = np.empty((len(imgs), height, width, imgs[0].shape[2]), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            batch[i] = np.pad(img, ((0, height - img.shape[0]), (0, width - img.shape[1]), (0, 0)), mode='edge')
+
+        output = self.predict(batch)
+
+        with self.lock:
+            self.batch_sizes[len(imgs)] += 1
+            self.served += len(imgs)
+            self.total_pixels += batch.shape[0] * height * width
+            self.padded_pixels += sum(height * width - img.shape[0] * img.shape[1] for img in imgs)
+
+        s = self.scale
+        return [output[i, :img.shape[0] * s, :img.shape[1] * s] for i, img in enumerate(imgs)]
+
+    def stats(self):
+        """Queue depth and batching statistics"""
+        with self.lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                'queue_depth': self.requests.qsize(),
+                'served': self.served,
+                'batches': batches,
+                'mean_batch_size': self.served / batches if batches else 0.0,
+                'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'padding_overhead': self.padded_pixels / self.total_pixels if self.total_pixels else 0.0
+            }
+
+
+def decode_image(data):
+    """Decode an encoded image into a normalized RGB float32 array in [-1, 1]"""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img.astype(np.float32) / 127.5 - 1
+
+
+def encode_image(img):
+    """Encode a generator output in [-1, 1] as PNG"""
+    out = np.clip(127.5 * img + 127.5, 0, 255).astype(np.uint8)
+    out = cv2.cvtColor(out, cv2.COLOR_RGB2BGR)
+    return cv2.imencode('.png', out)[1].tobytes()
+
+
+class UpscaleHandler(BaseHTTPRequestHandler):
+    """
+    POST /upscale with an encoded image as body returns the upscaled PNG.
+    GET /stats returns the scheduler statistics as JSON.
+
+    With a ResultCache set, repeated inputs are answered from disk without a forward pass.
+    """
+
+    scheduler = None
+    cache = None
+    cache_model = ''
+    cache_mode = ''
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_body(404, b'not found\n', 'text/plain')
+            return
+        stats = self.scheduler.stats()
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        self.send_body(200, json.dumps(stats).encode(), 'application/json')
+
+    def do_POST(self):
+        if self.path != '/upscale':
+            self.send_body(404, b'not found\n', 'text/plain')
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        img = decode_image(self.rfile.read(length))
+        if img is None:
+            self.send_body(400, b'could not decode image\n', 'text/plain')
+            return
+
+        if self.cache is None:
+            body = encode_image(self.scheduler.submit(img).result())
+        else:
+            key = resultKey(img, self.cache_model, self.scheduler.scale, self.cache_mode)
+            body = self.cache.cached(key, lambda: encode_image(self.scheduler.submit(img).result()))
+        self.send_body(200, body, 'image/png')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(gan, host='127.0.0.1', port=8000, max_batch=8, max_latency=0.01, pad=False, cache=None, model_id='', mode='',
+          bucket=None):
+    """
+    Serve a loaded srgan_deploy.SRGAN over HTTP until interrupted.
+
+    :param SRGAN gan: Deploy network with the generator weights loaded
+    :param str host: Interface to bind
+    :param int port: Port to listen on
+    :param int max_batch: Largest batch sent to the generator
+    :param float max_latency: Batching window in seconds
+    :param bool pad: Pad differently shaped images into one batch
+    :param ResultCache cache: On-disk cache of encoded results, or None
+    :param str model_id: modelIdentity of the generator weights, part of every cache key
+    :param str mode: Variant of the generator (e.g. 'fused'), part of every cache key
+    :param int bucket: Pad inputs up to multiples of bucket pixels, see BatchScheduler
+    """
+    if cache is not None and pad:
+        # Padded outputs depend on which requests shared the batch, so they can not be keyed by input
+        raise ValueError('The result cache can not be combined with pad')
+    from keras import backend as K
+
+    # Keras predict is called from the scheduler thread, so build the predict function
+    # up front and run it in the graph the generator was created in
+    gan.generator._make_predict_function()
+    graph = K.get_session().graph
+
+    def predict(batch):
+        with graph.as_default():
+            return gan.generator.predict(batch, batch_size=len(batch))
+
+    UpscaleHandler.scheduler = BatchScheduler(predict, gan.upscaling_factor, max_batch, max_latency, pad, bucket)
+    UpscaleHandler.cache = cache
+    UpscaleHandler.cache_model = model_id
+    UpscaleHandler.cache_mode = '{}|bucket={}'.format(mode, bucket or 0)
+    server = ThreadingHTTPServer((host, port), UpscaleHandler)
+    print(f">> Serving SRGAN generator on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+# Run the upscale service
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-batching SRGAN upscale service')
+    parser.add_argument('--weights', default='imagenet_generator.h5')
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-latency', type=float, default=10, help='batching window in milliseconds')
+    parser.add_argument('--pad', action='store_true', help='pad differently shaped images into one batch')
+    parser.add_argument('--fused', action='store_true', help='serve the generator with batch norms folded into the convolutions')
+    parser.add_argument('--fold-all', action='store_true', help='with --fused, also fold the batch norms that follow a ReLU')
+    parser.add_argument('--bucket', type=int, help='pad inputs up to multiples of this size and batch them by padded shape')
+    parser.add_argument('--variant', help='serve these float16 / int8 weights from network.quantize instead')
+    parser.add_argument('--cache', help='directory of the on-disk result cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='result cache limit in MB')
+    args = parser.parse_args()
+
+    from network.srgan_deploy import SRGAN
+    if args.cache and args.pad:
+        parser.error('--cache can not be combined with --pad')
+    gan = SRGAN(upscaling_factor=args.scale, weights=args.weights, fused=args.fused, exact=not args.fold_all,
+                variant=args.variant)
+    cache = ResultCache(args.cache, args.cache_size << 20) if args.cache else None
+    if args.variant:
+        mode = 'variant'
+    else:
+        mode = ('fused_all' if args.fold_all else 'fused') if args.fused else 'keras'
+    serve(gan, args.host, args.port, args.max_batch, args.max_latency / 1000, args.pad,
+          cache, modelIdentity(args.variant or args.weights) if cache else '', mode, args.bucket)
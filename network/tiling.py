@@ -0,0 +1,209 @@
+import math
+
+import cv2
+import numpy as np
+
+
+def receptive_field(model):
+    """
+    Walk the layers of a Keras model and work out how much context each output pixel needs.
+
+    Skip connections are shorter than the main path, so summing every convolution gives
+    a safe upper bound for networks such as the SRGAN generator.
+
+    :param model: Keras model built from Conv2D / UpSampling2D layers, or an engine with its own receptive_field()
+    :return: (halo, shrink, scale) where halo is the receptive field radius in input pixels,
+             shrink the number of input pixels lost per side to 'valid' padding
+             and scale the ratio between output and input size
+    """
+    if hasattr(model, 'receptive_field'):
+        return model.receptive_field()
+
+    radius = 0.0
+    shrink = 0.0
+    factor = 1
+    for layer in model.layers:
+        name = layer.__class__.__name__
+        if name == 'Conv2D':
+            dilation = layer.dilation_rate[0]
+            r = (layer.kernel_size[0] - 1) // 2 * dilation / factor
+            radius += r
+            if layer.padding == 'valid':
+                shrink += r
+        elif name == 'UpSampling2D':
+            factor *= layer.size[0]
+        elif name == 'Lambda' and layer.name.startswith('subpixel'):
+            factor *= layer.arguments['scale']
+    return int(math.ceil(radius)), int(round(shrink)), factor
+
+
+def tile_windows(length, tile, halo, shrink):
+    """
+    Split one image axis into output cores and the input windows that produce them.
+
+    Every window has the same size so that tiles can be batched together. Windows are
+    shifted inwards at the image border instead of being padded, which keeps the result
+    identical to whole-image inference.
+
+    :param int length: Size of the input along this axis
+    :param int tile: Core size in input pixels
+    :param int halo: Receptive field radius in input pixels
+    :param int shrink: Input pixels lost per side to 'valid' padding
+    :return: window size and a list of (core_start, core_end, window_start)
+    """
+    window = min(length, tile + 2 * halo)
+    windows = []
+    for start in range(shrink, length - shrink, tile):
+        end = min(start + tile, length - shrink)
+        offset = min(max(start - halo, 0), length - window)
+        windows.append((start, end, offset))
+    return window, windows
+
+
+def tile_energy(window):
+    """Mean squared finite difference of an input window, a cheap measure of its detail"""
+    dy = np.diff(window, axis=0)
+    dx = np.diff(window, axis=1)
+    return float((np.mean(dy * dy) + np.mean(dx * dx)) / 2) if dy.size and dx.size else 0.0
+
+
+class TiledInference():
+    """
+    Run a fully convolutional super-resolution model on overlapping tiles.
+
+    Peak memory depends on tile_size and batch_size instead of the image size, and the
+    stitched result matches a single predict call on the whole image.
+
+    In adaptive mode, tiles whose input window scores below threshold in tile_energy are
+    not sent through the model; their output comes from the fallback upscale (bicubic by
+    default). The seam between the two is blended over blend output pixels inside the
+    tiles that were processed, so flat tiles stay pure bicubic.
+    """
+
+    def __init__(self, model, tile_size=128, batch_size=4, halo=None, shrink=None, scale=None,
+                 adaptive=False, threshold=1e-4, blend=8, fallback=None):
+        """
+        :param model: Keras model (or any object with a compatible predict method)
+        :param int tile_size: Size of the output core of each tile, in input pixels
+        :param int batch_size: How many tiles to send through the model at once
+        :param int halo: Context around each core; computed from the model if None
+        :param int shrink: Pixels lost per side to 'valid' padding; computed from the model if None
+        :param int scale: Up-scaling factor of the model; computed from the model if None
+        :param bool adaptive: Skip the model on tiles with little detail
+        :param float threshold: tile_energy below which a tile is skipped, in squared input units
+            (the [0, 1] Y input of SRCNN, the [-1, 1] RGB input of SRGAN)
+        :param int blend: Width of the seam blend in output pixels
+        :param fallback: Function mapping the whole input to the model's output geometry.
+            Cropping for scale 1 models such as SRCNN, whose input is already bicubic, and
+            a bicubic resize otherwise, if None
+        """
+        self.model = model
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+
+        if halo is None or shrink is None or scale is None:
+            field = receptive_field(model)
+            halo = field[0] if halo is None else halo
+            shrink = field[1] if shrink is None else shrink
+            scale = field[2] if scale is None else scale
+
+        if halo < shrink:
+            raise ValueError('Halo must cover the pixels lost to valid padding')
+        self.halo = halo
+        self.shrink = shrink
+        self.scale = scale
+
+        self.adaptive = adaptive
+        self.threshold = threshold
+        self.blend = blend
+        self.fallback = fallback
+        self.stats = {'tiles': 0, 'skipped': 0}
+
+    def skipped_fraction(self):
+        """Fraction of all tiles seen so far that did not go through the model"""
+        return self.stats['skipped'] / self.stats['tiles'] if self.stats['tiles'] else 0.0
+
+    def upscale(self, img):
+        """Output of the fallback for the whole image, as float32"""
+        if self.fallback is not None:
+            return np.asarray(self.fallback(img), dtype=np.float32)
+        height, width = img.shape[:2]
+        core = img[self.shrink:height - self.shrink, self.shrink:width - self.shrink].astype(np.float32)
+        if self.scale == 1:
+            return core
+        out = cv2.resize(core, (core.shape[1] * self.scale, core.shape[0] * self.scale), interpolation=cv2.INTER_CUBIC)
+        return out.reshape(out.shape[0], out.shape[1], core.shape[2])
+
+    def tiles(self, height, width):
+        """
+        Plan the tiles for an input image.
+
+        :param int height: Input height
+        :param int width: Input width
+        :return: input window shape and a list of ((y0, y1, wy), (x0, x1, wx)) tiles
+        """
+        window_h, rows = tile_windows(height, self.tile_size, self.halo, self.shrink)
+        window_w, cols = tile_windows(width, self.tile_size, self.halo, self.shrink)
+        return (window_h, window_w), [(row, col) for row in rows for col in cols]
+
+    def predict(self, img):
+        """
+        Upscale one image.
+
+        :param numpy.ndarray img: Input of shape (height, width, channels), already normalized
+        :return: the model output of shape (out_height, out_width, out_channels)
+        """
+        height, width = img.shape[:2]
+        window, tiles = self.tiles(height, width)
+        if not tiles:
+            raise ValueError('Image is smaller than the receptive field of the model')
+
+        skipped = []
+        if self.adaptive:
+            flat = [tile_energy(img[wy:wy + window[0], wx:wx + window[1]]) < self.threshold
+                    for (_, _, wy), (_, _, wx) in tiles]
+            skipped = [tile for tile, f in zip(tiles, flat) if f]
+            tiles = [tile for tile, f in zip(tiles, flat) if not f]
+        self.stats['tiles'] += len(tiles) + len(skipped)
+        self.stats['skipped'] += len(skipped)
+
+        s = self.scale
+        out = None
+        mask = None
+        if skipped:
+            base = self.upscale(img)
+            out = base.copy()
+            mask = np.zeros(out.shape[:2], dtype=np.float32)
+            if not tiles:
+                return out
+        batch = np.empty((min(self.batch_size, len(tiles)), window[0], window[1], img.shape[2]), dtype=np.float32)
+
+        for first in range(0, len(tiles), self.batch_size):
+            group = tiles[first:first + self.batch_size]
+            for i, ((_, _, wy), (_, _, wx)) in enumerate(group):
+                batch[i] = img[wy:wy + window[0], wx:wx + window[1]]
+            pred = self.model.predict(batch[:len(group)], batch_size=len(group))
+
+            # Allocate the output once the channel count of the model is known
+            if out is None:
+                out = np.empty(((height - 2 * self.shrink) * s, (width - 2 * self.shrink) * s, pred.shape[3]), dtype=pred.dtype)
+
+            for i, ((y0, y1, wy), (x0, x1, wx)) in enumerate(group):
+                oy, ox = (y0 - self.shrink) * s, (x0 - self.shrink) * s
+                py, px = (y0 - wy - self.shrink) * s, (x0 - wx - self.shrink) * s
+                h, w = (y1 - y0) * s, (x1 - x0) * s
+                out[oy:oy + h, ox:ox + w] = pred[i, py:py + h, px:px + w]
+                if mask is not None:
+                    mask[oy:oy + h, ox:ox + w] = 1
+
+        if mask is not None:
+            # The weight ramps from 0 on the seam to 1 blend pixels inside the processed
+            # tiles; the image border counts as processed, so it is not faded
+            if self.blend > 0:
+                distance = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 5)
+                weight = np.clip(distance / self.blend, 0, 1)[:, :, None]
+            else:
+                weight = mask[:, :, None]
+            out = base + weight * (out - base)
+
+        return out
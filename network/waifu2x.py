@@ -2,41 +2,141 @@ from keras.models import Sequential
 from keras.layers import Conv2D
 from keras.layers.advanced_activations import LeakyReLU
 from keras.optimizers import Adam
+import os
 import json
+import hashlib
+import numpy as np
+
+
+def file_hash(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def build_cache(path, cache, source_hash):
+  """
+  Convert a waifu2x JSON model into one .npy file per kernel and bias plus meta.json.
+
+  Kernels are stored as Keras expects them, (kH, kW, nInputPlane, nOutputPlane), instead
+  of the (nOutputPlane, nInputPlane, kH, kW) nested lists of the JSON.
+  """
+  with open(path, 'rb') as f:
+    params = json.load(f)
+
+  # A temporary directory of this process, so concurrent builds never write into each other
+  tmp = '{}.{}.tmp'.format(cache, os.getpid())
+  remove_dir(tmp)
+  os.makedirs(tmp)
+  layers = []
+  for i, param in enumerate(params):
+    kernel = np.array(param['weight'], dtype=np.float32).reshape(
+      param['nOutputPlane'], param['nInputPlane'], param['kH'], param['kW'])
+    np.save(os.path.join(tmp, 'kernel_{}.npy'.format(i)), np.ascontiguousarray(kernel.transpose(2, 3, 1, 0)))
+    np.save(os.path.join(tmp, 'bias_{}.npy'.format(i)), np.array(param['bias'], dtype=np.float32))
+    layers.append({key: param[key] for key in ('nInputPlane', 'nOutputPlane', 'kH', 'kW')})
+
+  with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+    json.dump({'source_hash': source_hash, 'layers': layers}, f)
+
+  # Swap the finished cache in, so an interrupted conversion is never mistaken for a valid one.
+  # An outdated cache is renamed out of the way first; os.replace then only succeeds while no
+  # other build has put its own result in place, in which case that one is kept
+  if read_meta(cache).get('source_hash') == source_hash:
+    # Another process finished the same build first
+    remove_dir(tmp)
+    return
+  if os.path.isdir(cache):
+    old = '{}.{}.old'.format(cache, os.getpid())
+    try:
+      os.replace(cache, old)
+      remove_dir(old)
+    except OSError:
+      pass
+  try:
+    os.replace(tmp, cache)
+  except OSError:
+    remove_dir(tmp)
+
+
+def read_meta(cache):
+  try:
+    with open(os.path.join(cache, 'meta.json'), 'r') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def remove_dir(path):
+  if os.path.isdir(path):
+    for name in os.listdir(path):
+      os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+
+def load_params(path, cache=None):
+  """
+  Load the layers of a waifu2x JSON model through its binary cache.
+
+  The cache is (re)built when missing or when the hash of the JSON changed. Arrays are
+  memory-mapped, so loading costs little more than hashing the source.
+
+  :param str path: waifu2x JSON model
+  :param str cache: Cache directory; <path without .json>.cache if None
+  :return: list of dicts with nInputPlane, nOutputPlane, kH, kW, weight and bias per layer
+  """
+  cache = cache or os.path.splitext(path)[0] + '.cache'
+  source_hash = file_hash(path)
+
+  meta = read_meta(cache)
+  if meta.get('source_hash') != source_hash:
+    build_cache(path, cache, source_hash)
+    with open(os.path.join(cache, 'meta.json'), 'r') as f:
+      meta = json.load(f)
+
+  params = []
+  for i, layer in enumerate(meta['layers']):
+    layer = dict(layer)
+    layer['weight'] = np.load(os.path.join(cache, 'kernel_{}.npy'.format(i)), mmap_mode='r')
+    layer['bias'] = np.load(os.path.join(cache, 'bias_{}.npy'.format(i)), mmap_mode='r')
+    params.append(layer)
+  return params
+
 
 class waifu2x:
   def __init__(self):
     self.path = './model/waifu2x.json'
     self.params = []
     self.param_id = 0
-    with open(self.path, 'rb') as f:
-      self.params.append(json.load(f))
+    self.params.append(load_params(self.path))
 
     self.lr = 0.0003
     self.in_train = False
-    self.input_shape = (self.params[self.param_id][0]['nInputPlane'], 32, 32)
+    self.input_shape = (32, 32, self.params[self.param_id][0]['nInputPlane'])
 
   def network(self):
     network = Sequential()
-    network.add(Conv2D(
-      self.params[self.param_id][0]['nOutputPlane'],
-      (self.params[self.param_id][0]['kH'], self.params[self.param_id][0]['kW']),
-      kernel_initializer='zero',
-      padding='same',
-      #weights=[np.array(params[param_id][0]['weight']), np.array(params[param_id][0]['bias'])],
-      use_bias=True,
-      input_shape=self.input_shape))
-
-    network.add(LeakyReLU(0.1))
-
-    for param in self.params[self.param_id][1:]:
-        network.add(Conv2D(
-            param['nOutputPlane'],
-            (self.params[self.param_id][0]['kH'], self.params[self.param_id][0]['kW']),
-            kernel_initializer='zero',
-            padding='same',
-            #weights=[np.array(param['weight']), np.array(param['bias'])],
-            use_bias=True))
+    params = self.params[self.param_id]
+
+    if (self.in_train):
+      input_shape = self.input_shape
+    else:
+      input_shape = (None, None, self.input_shape[2])
+
+    for i, param in enumerate(params):
+      kwargs = {'input_shape': input_shape} if i == 0 else {}
+      network.add(Conv2D(
+        param['nOutputPlane'],
+        (param['kH'], param['kW']),
+        padding='same',
+        weights=[np.array(param['weight']), np.array(param['bias'])],
+        use_bias=True,
+        **kwargs))
+
+      # The last layer of the waifu2x models is linear
+      if i < len(params) - 1:
         network.add(LeakyReLU(0.1))
 
     adam = Adam(lr=self.lr)
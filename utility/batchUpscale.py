@@ -0,0 +1,271 @@
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+IMAGE_FORMATS = ('.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff', '.webp')
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS')
+BLAS_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+# Per-process state of a pool worker, filled by initWorker
+worker = {}
+
+
+def listJobs(inputs, output, overwrite=False):
+    """
+    Pair every image under the input directories with its output name.
+
+    Outputs mirror the directory structure below each input and are always PNG. Images
+    whose output already exists are left out unless overwrite is set, which makes an
+    interrupted run resumable.
+
+    :return: (jobs, skipped) where jobs is a list of (source, destination)
+    """
+    jobs = []
+    skipped = 0
+    for root in inputs:
+        for folder, _, files in os.walk(root):
+            for file in sorted(files):
+                if not file.lower().endswith(IMAGE_FORMATS):
+                    continue
+                source = os.path.join(folder, file)
+                relative = os.path.relpath(source, root)
+                if len(inputs) > 1:
+                    relative = os.path.join(os.path.basename(os.path.normpath(root)), relative)
+                destination = os.path.join(output, os.path.splitext(relative)[0] + '.png')
+                if os.path.exists(destination) and not overwrite:
+                    skipped += 1
+                    continue
+                jobs.append((source, destination))
+    return jobs, skipped
+
+
+def configureSession(threads):
+    """Give the Keras TensorFlow session threads intra-op threads and a single inter-op thread"""
+    import tensorflow as tf
+    from keras import backend as K
+    tf1 = tf.compat.v1 if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1') else tf
+    config = tf1.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+    K.set_session(tf1.Session(config=config))
+
+
+def initWorker(name, engine, modelPath, threads, tileSize, cachePath, cacheBytes, variant=None):
+    """Load the model once per pool worker"""
+    from utility.benchmark import MODELS, load_model
+
+    cv2.setNumThreads(1)
+    spec = MODELS[name]
+    # The SRGAN generator always runs in Keras, whatever the engine
+    if engine == 'keras' or spec['kind'] == 'srgan':
+        configureSession(threads)
+    model = load_model(name, engine, modelPath, threads, variant)
+
+    worker['kind'] = spec['kind']
+    worker['scale'] = spec['scale']
+    worker['model'] = model
+    worker['tiled'] = None
+    if tileSize:
+        from network.tiling import TiledInference
+        worker['tiled'] = TiledInference(model, tile_size=tileSize)
+    if spec['kind'] == 'srcnn':
+        from utility.srcnnProcess import SrcnnProcessor
+        worker['processor'] = SrcnnProcessor(spec['scale'])
+
+    worker['cache'] = None
+    if cachePath:
+        from utility.resultCache import ResultCache, modelIdentity
+        files = [os.path.join(modelPath, spec[key]) for key in ('network', 'weight') if key in spec]
+        if engine == 'variant':
+            files[-1] = variant
+        worker['cache'] = ResultCache(cachePath, cacheBytes)
+        worker['cacheModel'] = modelIdentity(*files)
+        worker['cacheMode'] = '{}:{}'.format(engine, tileSize or 0)
+
+
+def predict(x):
+    """Run the worker's model on a (1, h, w, c) batch, tile by tile when configured"""
+    if worker['tiled'] is None:
+        return worker['model'].predict(x, batch_size=1)
+    return worker['tiled'].predict(x[0])[None]
+
+
+def upscale(img):
+    """Upscale one BGR uint8 image with the worker's model and return it PNG encoded"""
+    if worker['kind'] == 'srcnn':
+        processor = worker['processor']
+        hr, tensor = processor.preprocess(img)
+        out = processor.postprocess(hr, predict(tensor))
+    else:
+        x = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 127.5 - 1
+        out = np.clip(127.5 * predict(x[None])[0] + 127.5, 0, 255).astype(np.uint8)
+        out = cv2.cvtColor(out, cv2.COLOR_RGB2BGR)
+    return cv2.imencode('.png', out)[1].tobytes()
+
+
+def writeFile(destination, data):
+    """Write through a temporary file so an interrupted run never leaves a partial output"""
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    tmp = '{}.{}.tmp'.format(destination, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, destination)
+
+
+def upscaleChunk(jobs):
+    """
+    Upscale a list of (source, destination) pairs in a pool worker.
+
+    The next image is decoded and the previous result encoded and written on helper
+    threads while the model runs on the current one.
+
+    :return: (done, failed) counts
+    """
+    done = 0
+    failed = 0
+    cache = worker['cache']
+
+    def finish(writing, destination):
+        try:
+            writing.result()
+            return True
+        except Exception as e:
+            print(">> could not write " + destination + ": " + str(e))
+            return False
+
+    with ThreadPoolExecutor(2) as io:
+        reading = io.submit(cv2.imread, jobs[0][0], cv2.IMREAD_COLOR)
+        writing = None
+        for i, (source, destination) in enumerate(jobs):
+            img = reading.result()
+            if i + 1 < len(jobs):
+                reading = io.submit(cv2.imread, jobs[i + 1][0], cv2.IMREAD_COLOR)
+            if img is None:
+                print(">> could not read " + source)
+                failed += 1
+                continue
+
+            # One bad image must not take the rest of the chunk with it
+            try:
+                if cache is None:
+                    data = upscale(img)
+                else:
+                    from utility.resultCache import resultKey
+                    key = resultKey(img, worker['cacheModel'], worker['scale'], worker['cacheMode'])
+                    data = cache.cached(key, lambda: upscale(img))
+            except Exception as e:
+                print(">> could not upscale " + source + ": " + str(e))
+                failed += 1
+                continue
+
+            if writing is not None:
+                if finish(*writing):
+                    done += 1
+                else:
+                    failed += 1
+            writing = (io.submit(writeFile, destination, data), destination)
+        if writing is not None:
+            if finish(*writing):
+                done += 1
+            else:
+                failed += 1
+    return done, failed
+
+
+def batchUpscale(inputs, output, name, engine='numpy', modelPath='./model/', workers=None, threads=None,
+                 chunk=8, tileSize=None, overwrite=False, cachePath=None, cacheBytes=1 << 30, variant=None):
+    """
+    Upscale every image under the input directories on a process pool.
+
+    :param list inputs: Input directories
+    :param str output: Output directory
+    :param str name: Model, a key of benchmark.MODELS
+    :param str engine: Inference engine, as for benchmark.load_model
+    :param str modelPath: Directory holding the model files
+    :param int workers: Worker processes; one per 4 cores if None
+    :param int threads: Intra-op threads per worker; the cores split evenly between workers if None
+    :param int chunk: Images handed to a worker at a time
+    :param int tileSize: Run the model on tiles of this size, or on whole images if None
+    :param bool overwrite: Redo images whose output already exists
+    :param str cachePath: Directory of a ResultCache shared by all workers, or None
+    :param int cacheBytes: Size limit of the result cache
+    :param str variant: float16 / int8 weights from network.quantize, for the 'variant' engine
+    :return: summary dict
+    """
+    from utility.benchmark import MODELS, ENGINES
+
+    if engine == 'variant' and not variant:
+        # Checked here, since a worker failing to initialize is restarted by the pool forever
+        raise ValueError("the 'variant' engine needs a variant file")
+    cores = os.cpu_count() or 1
+    workers = workers or max(1, cores // 4)
+    threads = threads or max(1, cores // workers)
+
+    jobs, skipped = listJobs(inputs, output, overwrite)
+    summary = {'images': len(jobs), 'skipped': skipped, 'done': 0, 'failed': 0,
+               'workers': workers, 'threads': threads}
+    if not jobs:
+        return summary
+
+    # Spawned workers inherit the environment, so BLAS / OpenMP / TensorFlow see their
+    # share of the cores from the first import instead of one thread pool per core each
+    saved = {key: os.environ.get(key) for key in THREAD_VARIABLES}
+    os.environ.update({key: str(threads) for key in THREAD_VARIABLES})
+    if engine in ('numpy', 'variant') and MODELS[name]['kind'] == 'srcnn':
+        # The NumPy engine splits every layer over its own threads, so BLAS runs single threaded under them
+        os.environ.update({key: '1' for key in BLAS_VARIABLES})
+    start = time.perf_counter()
+    try:
+        context = multiprocessing.get_context('spawn')
+        chunks = [jobs[i:i + chunk] for i in range(0, len(jobs), chunk)]
+        with context.Pool(workers, initWorker, (name, engine, modelPath, threads, tileSize, cachePath, cacheBytes, variant)) as pool:
+            for done, failed in pool.imap_unordered(upscaleChunk, chunks):
+                summary['done'] += done
+                summary['failed'] += failed
+                print(">> {}/{} images".format(summary['done'] + summary['failed'], len(jobs)))
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    summary['seconds'] = time.perf_counter() - start
+    summary['images_per_second'] = summary['done'] / summary['seconds']
+    return summary
+
+
+# Upscale whole directories
+if __name__ == '__main__':
+    from utility.benchmark import MODELS, ENGINES
+
+    parser = argparse.ArgumentParser(description='Upscale every image of one or more directories')
+    parser.add_argument('inputs', nargs='+', help='input directories')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--model', default='srcnn_2x', choices=sorted(MODELS))
+    parser.add_argument('--engine', default='numpy', choices=sorted(set(sum(ENGINES.values(), ()))))
+    parser.add_argument('--model-path', default='./model/')
+    parser.add_argument('--variant', help='float16 / int8 weights from network.quantize, for --engine variant')
+    parser.add_argument('--workers', type=int, help='worker processes, default one per 4 cores')
+    parser.add_argument('--threads', type=int, help='intra-op threads per worker, default cores / workers')
+    parser.add_argument('--chunk', type=int, default=8, help='images handed to a worker at a time')
+    parser.add_argument('--tile-size', type=int, help='run the model on tiles of this size')
+    parser.add_argument('--overwrite', action='store_true', help='redo images whose output already exists')
+    parser.add_argument('--cache', help='directory of the on-disk result cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='result cache limit in MB')
+    args = parser.parse_args()
+
+    if args.engine not in ENGINES[MODELS[args.model]['kind']]:
+        parser.error('{} can not run on --engine {}'.format(args.model, args.engine))
+    if args.engine == 'variant' and not args.variant:
+        parser.error('--engine variant needs --variant')
+
+    summary = batchUpscale(args.inputs, args.output, args.model, args.engine, args.model_path, args.workers,
+                           args.threads, args.chunk, args.tile_size, args.overwrite, args.cache, args.cache_size << 20,
+                           args.variant)
+    print(">> {done} upscaled, {skipped} already done, {failed} failed".format(**summary))
+    if 'seconds' in summary:
+        print(">> {:.1f} s, {:.2f} images/s".format(summary['seconds'], summary['images_per_second']))
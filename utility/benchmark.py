@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+
+import cv2
+import numpy as np
+
+SIZE_CONV = 6
+INTERPOLATION = cv2.INTER_CUBIC
+
+MODELS = {
+    'srcnn_2x': {'kind': 'srcnn', 'scale': 2, 'network': 'yayoi_srcnn_935_2x_network.json',
+                 'weight': 'yayoi_srcnn_935_2x_weight.h5', 'graph': 'yayoi_srcnn_935_2x.pb'},
+    'srcnn_4x': {'kind': 'srcnn', 'scale': 4, 'network': 'yayoi_srcnn_955_4x_network_64.json',
+                 'weight': 'yayoi_srcnn_955_4x_weight_64.h5', 'graph': 'yayoi_srcnn_955_4x.pb'},
+    'srgan_4x': {'kind': 'srgan', 'scale': 4, 'weight': 'imagenet_generator.h5'}
+}
+
+# Inference engines each kind of model can run on
+ENGINES = {'srcnn': ('keras', 'numpy', 'frozen', 'variant'), 'srgan': ('keras', 'fused', 'variant')}
+
+# Input sizes: SRCNN works at HR size, the SRGAN generator at LR size
+SIZES = {'srcnn': [(64, 64), (256, 256), (512, 512), (1024, 1024)], 'srgan': [(32, 32), (64, 64), (128, 128)]}
+BATCHES = [1, 4]
+
+# Root of the repository, where the measuring subprocesses run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_model(name, engine, model_path, threads=0, variant=None):
+    """
+    :param str name: key of MODELS
+    :param str engine: one of ENGINES of the model kind; 'variant' runs the float16 / int8 weights of the variant file
+    :param str model_path: directory holding the model files
+    :param int threads: intra-op threads of the frozen graph session, 0 lets TensorFlow decide; row band
+        threads of the NumPy engines, 0 for one
+    :param str variant: .npz written by network.quantize, required by the 'variant' engine
+    :return: object with a Keras-style predict method
+    """
+    spec = MODELS[name]
+    if engine not in ENGINES[spec['kind']]:
+        raise ValueError("{} can not run on the '{}' engine, only on {}".format(name, engine, ', '.join(ENGINES[spec['kind']])))
+    if engine == 'variant' and not variant:
+        raise ValueError("the 'variant' engine needs a variant file")
+    if spec['kind'] == 'srgan':
+        from network.srgan_deploy import SRGAN
+        gan = SRGAN(upscaling_factor=spec['scale'], weights=os.path.join(model_path, spec['weight']), fused=engine == 'fused',
+                    variant=variant if engine == 'variant' else None)
+        return gan.generator
+    if engine == 'variant':
+        from network.quantize import QuantizedSRCNN
+        return QuantizedSRCNN(os.path.join(model_path, spec['network']), variant, max(1, threads))
+    if engine == 'numpy':
+        from network.srcnn_numpy import NumpySRCNN
+        return NumpySRCNN(os.path.join(model_path, spec['network']), os.path.join(model_path, spec['weight']), max(1, threads))
+    if engine == 'frozen':
+        from network.frozen_graph import FrozenGraph
+        return FrozenGraph(os.path.join(model_path, spec['graph']), intra_op_threads=threads, inter_op_threads=1 if threads else 0)
+
+    from keras.models import model_from_json
+    with open(os.path.join(model_path, spec['network']), 'r') as f:
+        model = model_from_json(f.read())
+    model.load_weights(os.path.join(model_path, spec['weight']))
+    return model
+
+
+def synthetic_image(height, width, seed=0):
+    """Deterministic BGR test image: smooth gradients, edges and a little noise"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:height, :width].astype(np.float32)
+    base = 127 + 60 * np.sin(x / 9.) * np.cos(y / 13.) + 40 * ((x // 32 + y // 32) % 2)
+    img = np.stack((base, 255 - base, base * 0.5 + 64), axis=-1) + rng.normal(0, 4, (height, width, 3))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def model_input(kind, shape, batch, seed=0):
+    img = synthetic_image(shape[0], shape[1], seed)
+    if kind == 'srgan':
+        x = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 127.5 - 1
+    else:
+        x = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0:1].astype(np.float32) / 255.
+    return np.repeat(x[None], batch, axis=0)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+def time_latency(model, x, repeat):
+    """First call and warm latencies in milliseconds, and the output"""
+    start = time.perf_counter()
+    out = model.predict(x, batch_size=len(x))
+    cold = (time.perf_counter() - start) * 1000
+    warm = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.predict(x, batch_size=len(x))
+        warm.append((time.perf_counter() - start) * 1000)
+    return cold, np.array(warm), out
+
+
+def measure(name, engine, model_path, shape, batch, repeat, variant=None):
+    """
+    Load a model and time one shape and batch size on it, meant to run in a fresh process.
+
+    :return: load and cold latency, warm samples, output pixels, and the peak RSS after
+        loading and after inference
+    """
+    start = time.perf_counter()
+    model = load_model(name, engine, model_path, variant=variant)
+    load_ms = (time.perf_counter() - start) * 1000
+    load_rss = peak_rss_mb()
+    cold, warm, out = time_latency(model, model_input(MODELS[name]['kind'], shape, batch), repeat)
+    return {
+        'load_ms': load_ms, 'cold_ms': cold, 'warm_ms': warm.tolist(),
+        'pixels': out.shape[0] * out.shape[1] * out.shape[2],
+        'load_rss_mb': load_rss, 'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def measure_fresh(name, engine, model_path, shape, batch, repeat, variant=None):
+    """Run measure in a new interpreter, so nothing is loaded, compiled or cached yet"""
+    args = json.dumps([name, engine, os.path.abspath(model_path), shape, batch, repeat,
+                       variant and os.path.abspath(variant)])
+    output = subprocess.check_output([sys.executable, '-m', 'utility.benchmark', '--measure', args], cwd=ROOT)
+    # The result is the last line, after anything the frameworks print while loading
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else float(10 * np.log10(255. ** 2 / mse))
+
+
+def ssim(a, b):
+    """Mean SSIM of two single-channel uint8 images, with the usual 11x11 Gaussian window"""
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    def blur(img):
+        return cv2.GaussianBlur(img, (11, 11), 1.5)
+
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def quality(model, kind, scale, img):
+    """
+    PSNR / SSIM of the model and of plain bicubic against the original, on the Y channel.
+
+    :param numpy.ndarray img: original BGR image, used as ground truth
+    """
+    img = img[:img.shape[0] // scale * scale, :img.shape[1] // scale * scale]
+    lr = cv2.resize(img, (img.shape[1] // scale, img.shape[0] // scale), interpolation=INTERPOLATION)
+    bicubic = cv2.resize(lr, (img.shape[1], img.shape[0]), interpolation=INTERPOLATION)
+    hr_y = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    bicubic_y = cv2.cvtColor(bicubic, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+
+    if kind == 'srgan':
+        x = cv2.cvtColor(lr, cv2.COLOR_BGR2RGB).astype(np.float32) / 127.5 - 1
+        out = np.clip(127.5 * model.predict(x[None])[0] + 127.5, 0, 255).astype(np.uint8)
+        out_y = cv2.cvtColor(out, cv2.COLOR_RGB2YCrCb)[:, :, 0]
+        border = slice(None)
+    else:
+        x = bicubic_y.astype(np.float32)[None, :, :, None] / 255.
+        out_y = np.clip(model.predict(x)[0, :, :, 0] * 255., 0, 255).astype(np.uint8)
+        border = slice(SIZE_CONV, -SIZE_CONV)
+
+    hr_y, bicubic_y = hr_y[border, border], bicubic_y[border, border]
+    return {
+        'psnr': psnr(hr_y, out_y), 'ssim': ssim(hr_y, out_y),
+        'bicubic_psnr': psnr(hr_y, bicubic_y), 'bicubic_ssim': ssim(hr_y, bicubic_y)
+    }
+
+
+def run(models, engine, model_path, images, repeat=10, variant=None, cold_runs=3):
+    """
+    Benchmark every model over the synthetic sizes and batch sizes, then measure quality
+    on the real images.
+
+    Every size and batch size is measured cold_runs times, each in a fresh process, so
+    every load and first call is really cold and the peak RSS belongs to that
+    configuration alone. Cold and load times are medians over the runs, warm percentiles
+    pool the samples of all runs.
+
+    :return: report dict, stable between runs of the same configuration
+    """
+    report = {
+        'meta': {
+            'engine': engine, 'variant': variant, 'repeat': repeat, 'cold_runs': cold_runs,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')
+        },
+        'latency': [],
+        'quality': []
+    }
+
+    for name in models:
+        spec = MODELS[name]
+        for shape in SIZES[spec['kind']]:
+            for batch in BATCHES:
+                runs = [measure_fresh(name, engine, model_path, shape, batch, repeat, variant) for _ in range(cold_runs)]
+                load = np.array([r['load_ms'] for r in runs])
+                cold = np.array([r['cold_ms'] for r in runs])
+                warm = np.concatenate([r['warm_ms'] for r in runs])
+                report['latency'].append({
+                    'model': name, 'size': '{}x{}'.format(*shape), 'batch': batch, 'runs': cold_runs,
+                    'load_ms': round(float(np.median(load)), 3),
+                    'cold_ms': round(float(np.median(cold)), 3),
+                    'cold_max_ms': round(float(cold.max()), 3),
+                    'p50_ms': round(float(np.percentile(warm, 50)), 3),
+                    'p90_ms': round(float(np.percentile(warm, 90)), 3),
+                    'p99_ms': round(float(np.percentile(warm, 99)), 3),
+                    'mpix_per_s': round(runs[0]['pixels'] / 1e6 / (warm.mean() / 1000), 3),
+                    'peak_rss_mb': round(max(r['peak_rss_mb'] for r in runs), 1),
+                    'rss_growth_mb': round(max(r['peak_rss_mb'] - r['load_rss_mb'] for r in runs), 1)
+                })
+
+        model = load_model(name, engine, model_path, variant=variant)
+        for img_name in images:
+            img = cv2.imread(img_name, cv2.IMREAD_COLOR)
+            if img is None:
+                continue
+            result = {'model': name, 'image': os.path.basename(img_name)}
+            result.update({k: round(v, 4) for k, v in quality(model, spec['kind'], spec['scale'], img).items()})
+            report['quality'].append(result)
+
+    return report
+
+
+def compare(old, new, latency_tolerance=0.1, psnr_tolerance=0.05):
+    """
+    List the regressions of a report against an earlier one.
+
+    :param float latency_tolerance: accepted relative p50 slow-down
+    :param float psnr_tolerance: accepted PSNR loss in dB
+    """
+    regressions = []
+    old_latency = {(r['model'], r['size'], r['batch']): r for r in old['latency']}
+    for r in new['latency']:
+        before = old_latency.get((r['model'], r['size'], r['batch']))
+        if before and r['p50_ms'] > before['p50_ms'] * (1 + latency_tolerance):
+            regressions.append('{} {} batch {}: p50 {} ms -> {} ms'.format(
+                r['model'], r['size'], r['batch'], before['p50_ms'], r['p50_ms']))
+    old_quality = {(r['model'], r['image']): r for r in old['quality']}
+    for r in new['quality']:
+        before = old_quality.get((r['model'], r['image']))
+        if before and r['psnr'] < before['psnr'] - psnr_tolerance:
+            regressions.append('{} {}: PSNR {} dB -> {} dB'.format(r['model'], r['image'], before['psnr'], r['psnr']))
+    return regressions
+
+
+# Run the benchmark suite
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inference benchmark across models, scales and image sizes')
+    parser.add_argument('--models', nargs='+', default=['srcnn_2x', 'srcnn_4x'], choices=sorted(MODELS))
+    parser.add_argument('--engine', default='keras', choices=sorted(set(sum(ENGINES.values(), ()))))
+    parser.add_argument('--model-path', default='./model/')
+    parser.add_argument('--variant', help='float16 / int8 weights from network.quantize, for --engine variant')
+    parser.add_argument('--images', default='./imageValidate2/')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--cold-runs', type=int, default=3, help='fresh processes per size and batch size')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier report to check for regressions')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # One configuration in this fresh process, see measure_fresh
+        print(json.dumps(measure(*json.loads(args.measure))))
+        raise SystemExit(0)
+
+    for name in args.models:
+        if args.engine not in ENGINES[MODELS[name]['kind']]:
+            parser.error('{} can not run on --engine {}'.format(name, args.engine))
+    if args.engine == 'variant' and not args.variant:
+        parser.error('--engine variant needs --variant')
+
+    images = []
+    if os.path.isdir(args.images):
+        images = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))]
+
+    report = run(args.models, args.engine, args.model_path, images, args.repeat, args.variant, args.cold_runs)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(args.output + " saved")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report)
+        for line in regressions:
+            print(">> regression: " + line)
+        if regressions:
+            raise SystemExit(1)
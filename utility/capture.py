@@ -0,0 +1,211 @@
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import h5py
+import numpy as np
+
+from utility.dataParse import SCALE, SIZE_PATCH, SIZE_CONV, BLOCK_STEP, imageY, patchPairs
+from utility.h5data import h5DataCreate, h5DataAppend, h5DataCheckAppend
+
+
+class Capture():
+    """
+    Grab a frame from a camera or video every period seconds and store it off the capture thread.
+
+    The capture loop sleeps until the next deadline instead of polling the clock. Frames
+    go to a pool of writer threads, so a slow disk builds a backlog instead of delaying
+    or dropping captures. Frames are written as PNG files, or, with an h5 file, cut
+    into SRCNN Y-channel patches by the pool and appended to the training datasets by a
+    single h5 writer thread. At most backlog frames wait to be stored; beyond that the
+    capture loop waits too, and the deadlines it misses are counted.
+    """
+
+    def __init__(self, source=0, period=1.0, outputPath='../image/', prefix='yayoi_', writers=2, h5File=None,
+                 scale=SCALE, size=SIZE_PATCH, conv=SIZE_CONV, step=BLOCK_STEP, crop=None, seed=0,
+                 compression=None, preview=False, backlog=64):
+        """
+        :param source: Capture device number or video file
+        :param float period: Seconds between captures
+        :param str outputPath: Folder of the PNG files
+        :param str prefix: File name prefix of the PNG files, followed by the frame number
+        :param int writers: Threads encoding / cutting frames
+        :param str h5File: Append patches to this SRCNN h5 file instead of writing PNG files
+        :param int scale: Down-scaling factor of the network input patches
+        :param int size: Input patch size
+        :param int conv: Border removed from the labels by the valid convolutions
+        :param int step: Stride of the dense patch grid
+        :param int crop: Random patches per frame instead of a grid
+        :param int seed: Seed of the random crops; frame i uses seed + i
+        :param str compression: h5py compression filter of a new h5 file
+        :param bool preview: Show the frames in a window; q stops the capture
+        :param int backlog: Most frames waiting to be stored, bounding the memory a slow disk can take
+        """
+        self.source = source
+        self.period = period
+        self.outputPath = outputPath
+        self.prefix = prefix
+        self.writers = writers
+        self.h5File = h5File
+        self.params = {'scale': scale, 'size': size, 'conv': conv, 'step': step, 'crop': crop}
+        self.seed = seed
+        self.compression = compression
+        self.preview = preview
+
+        self.slots = threading.BoundedSemaphore(backlog)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.maxPending = 0
+        self.written = 0
+        self.patches = 0
+        self.errors = 0
+
+    def track(self, future, stored=True):
+        """Count a pending job; the frame's backlog slot is freed once it is stored, or the job failed"""
+        with self.lock:
+            self.pending += 1
+            self.maxPending = max(self.maxPending, self.pending)
+        future.add_done_callback(lambda f: self.done(f, stored))
+
+    def done(self, future, stored):
+        with self.lock:
+            self.pending -= 1
+            if future.exception() is not None:
+                self.errors += 1
+                print(">> write failed: " + str(future.exception()))
+        if stored or future.exception() is not None:
+            self.slots.release()
+
+    def writePng(self, img, count):
+        fileName = os.path.join(self.outputPath, self.prefix + str(count) + '.png')
+        if not cv2.imwrite(fileName, img, [int(cv2.IMWRITE_PNG_COMPRESSION), 0]):
+            raise IOError("could not write " + fileName)
+        with self.lock:
+            self.written += 1
+
+    def cutPatches(self, img, count, h5, appender):
+        p = self.params
+        hr_img, lr_img = imageY(img, p['scale'])
+        rng = np.random.RandomState(self.seed + count)
+        data, label = patchPairs(hr_img, lr_img, p['size'], p['conv'], p['step'], p['crop'], rng)
+        # h5py is not thread safe, so every append goes through the one appender thread
+        self.track(appender.submit(self.appendPatches, h5, data, label))
+
+    def appendPatches(self, h5, data, label):
+        h5DataAppend(h5, data, label)
+        with self.lock:
+            self.written += 1
+            self.patches += data.shape[0]
+
+    def wait(self, deadline):
+        """Sleep until deadline; return False when the preview window asked to stop"""
+        remaining = deadline - time.monotonic()
+        if not self.preview:
+            if remaining > 0:
+                time.sleep(remaining)
+            return True
+        key = cv2.waitKey(max(1, int(remaining * 1000))) & 0xFF
+        return key not in (ord('q'), ord('Q'))
+
+    def run(self, count):
+        """
+        Capture count frames.
+
+        :return: frames captured, deadlines missed, frames stored, patches, write errors and
+            the largest writer backlog
+        """
+        p = self.params
+        label = p['size'] - 2 * p['conv']
+        dataShape, labelShape = (p['size'], p['size'], 1), (label, label, 1)
+        if self.h5File and os.path.exists(self.h5File):
+            # Refuse files the appender would fail on or that another tool would overwrite
+            if os.path.exists(self.h5File + '.manifest.json'):
+                raise ValueError(self.h5File + ' is managed by dataParse.updateDataset, which would discard appended rows')
+            with h5py.File(self.h5File, 'r') as hf:
+                h5DataCheckAppend(hf, dataShape, labelShape)
+
+        capture = cv2.VideoCapture(int(self.source) if str(self.source).isdigit() else self.source)
+        if not capture.isOpened():
+            raise IOError("could not open " + str(self.source))
+
+        h5 = None
+        if self.h5File:
+            if os.path.exists(self.h5File):
+                h5 = h5py.File(self.h5File, 'a')
+            else:
+                h5 = h5DataCreate(self.h5File, dataShape, labelShape, compression=self.compression)
+        else:
+            os.makedirs(self.outputPath, exist_ok=True)
+
+        pool = ThreadPoolExecutor(self.writers)
+        appender = ThreadPoolExecutor(1)
+        captured = 0
+        missed = 0
+        try:
+            deadline = time.monotonic()
+            while captured < count:
+                if not self.wait(deadline):
+                    break
+                # Keep the schedule of the first frame, skipping deadlines that have already passed
+                now = time.monotonic()
+                late = int((now - deadline) // self.period)
+                missed += late
+                deadline += (late + 1) * self.period
+
+                grabbed, img = capture.read()
+                if not grabbed:
+                    if not str(self.source).isdigit():
+                        break
+                    print(">> no signal")
+                    continue
+                if self.preview:
+                    cv2.imshow("capture", img)
+
+                # Wait for a backlog slot, so a slow disk holds back capture instead of filling memory
+                self.slots.acquire()
+                if h5 is None:
+                    self.track(pool.submit(self.writePng, img, captured))
+                else:
+                    self.track(pool.submit(self.cutPatches, img, captured, h5, appender), stored=False)
+                captured += 1
+        finally:
+            capture.release()
+            pool.shutdown(wait=True)
+            appender.shutdown(wait=True)
+            if h5 is not None:
+                h5.close()
+            if self.preview:
+                cv2.destroyAllWindows()
+
+        return {'captured': captured, 'missed': missed, 'written': self.written, 'patches': self.patches,
+                'errors': self.errors, 'max_pending': self.maxPending}
+
+
+# Capture training images from a camera
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Periodic frame capture into PNG files or SRCNN h5 training data')
+    parser.add_argument('--source', default='0', help='capture device number or video file')
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--period', type=float, default=1.0, help='seconds between frames')
+    parser.add_argument('--output', default='../image/')
+    parser.add_argument('--prefix', default='yayoi_')
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--h5', help='append Y-channel patches to this h5 file instead of writing PNG files')
+    parser.add_argument('--scale', type=int, default=SCALE)
+    parser.add_argument('--size', type=int, default=SIZE_PATCH)
+    parser.add_argument('--conv', type=int, default=SIZE_CONV)
+    parser.add_argument('--step', type=int, default=BLOCK_STEP)
+    parser.add_argument('--crop', type=int, default=None, help='random patches per frame instead of a grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--preview', action='store_true')
+    parser.add_argument('--backlog', type=int, default=64, help='most frames waiting to be stored')
+    args = parser.parse_args()
+
+    capture = Capture(args.source, args.period, args.output, args.prefix, args.writers, args.h5, args.scale,
+                      args.size, args.conv, args.step, args.crop, args.seed, preview=args.preview, backlog=args.backlog)
+    report = capture.run(args.count)
+    print(">> {captured} frames captured, {written} stored, {missed} deadlines missed, "
+          "{errors} errors, largest backlog {max_pending}".format(**report))
@@ -1,4 +1,19 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GOOGLE_DRIVE_URL = "https://docs.google.com/uc?export=download"
+BLOCK_SIZE = 1 << 20
+MIN_SEGMENT = 8 << 20
 
 def get_confirm_token(response):
     for key, value in response.cookies.items():
@@ -7,16 +22,18 @@ def get_confirm_token(response):
 
     return None
 
-def save_response_content(response, destination):
+def save_response_content(response, destination, mode="wb", counter=None):
     CHUNK_SIZE = 32768
 
-    with open(destination, "wb") as f:
+    with open(destination, mode) as f:
         for chunk in response.iter_content(CHUNK_SIZE):
             if chunk: # filter out keep-alive new chunks
                 f.write(chunk)
+                if counter is not None:
+                    counter.add(len(chunk))
 
 def download_file_from_google_drive(id, destination):
-    URL = "https://docs.google.com/uc?export=download"
+    URL = GOOGLE_DRIVE_URL
 
     session = requests.Session()
 
@@ -29,3 +46,217 @@ def download_file_from_google_drive(id, destination):
 
     save_response_content(response, destination)
 
+
+class ByteCounter():
+    """Thread-safe count of downloaded bytes"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+
+def make_session(pool_size=16, retries=3):
+    """A requests.Session whose connections are pooled and reused by all download threads"""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def resolve(session, entry, base_url=None):
+    """
+    URL and query parameters of a manifest entry.
+
+    Entries name either a url, absolute or relative to base_url, or a Google Drive id,
+    whose large-file confirmation token is fetched here.
+    """
+    if 'id' in entry:
+        params = {'id': entry['id']}
+        response = session.get(GOOGLE_DRIVE_URL, params=params, stream=True)
+        token = get_confirm_token(response)
+        response.close()
+        if token:
+            params['confirm'] = token
+        return GOOGLE_DRIVE_URL, params
+    return urljoin(base_url, entry['url']) if base_url else entry['url'], None
+
+
+def probe(session, url, params=None):
+    """
+    Ask for the first byte to learn the size and whether the server honours Range.
+
+    :return: (size or None, supports_range)
+    """
+    response = session.get(url, params=params, headers={'Range': 'bytes=0-0'}, stream=True)
+    try:
+        response.raise_for_status()
+        if response.status_code == 206 and '/' in response.headers.get('Content-Range', ''):
+            total = response.headers['Content-Range'].rsplit('/', 1)[1]
+            return (int(total) if total != '*' else None), True
+        length = response.headers.get('Content-Length')
+        return (int(length) if length else None), False
+    finally:
+        response.close()
+
+
+def file_hash(path, algorithm='sha256'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify(path, entry):
+    """Raise ValueError when path does not have the size and hash the manifest entry expects"""
+    if 'size' in entry and os.path.getsize(path) != entry['size']:
+        raise ValueError('{}: size {} != {}'.format(path, os.path.getsize(path), entry['size']))
+    for algorithm in ('sha256', 'md5'):
+        if algorithm in entry:
+            digest = file_hash(path, algorithm)
+            if digest != entry[algorithm].lower():
+                raise ValueError('{}: {} {} != {}'.format(path, algorithm, digest, entry[algorithm]))
+
+
+def fetch_segment(session, url, params, part, start, end, counter):
+    """Download bytes [start, end] into part, continuing from what part already holds"""
+    done = os.path.getsize(part) if os.path.exists(part) else 0
+    if start + done > end:
+        return
+    headers = {'Range': 'bytes={}-{}'.format(start + done, end)}
+    response = session.get(url, params=params, headers=headers, stream=True)
+    try:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('{}: server ignored the Range request'.format(url))
+        save_response_content(response, part, 'ab', counter)
+    finally:
+        response.close()
+
+
+def download_file(session, entry, output, base_url=None, segments=4, min_segment=MIN_SEGMENT, counter=None):
+    """
+    Download one manifest entry into output, resuming earlier attempts.
+
+    When the server supports Range requests, the file is split into up to segments parts
+    of at least min_segment bytes that download in parallel, each into its own .part file
+    that a later run continues. Otherwise the file is streamed whole. The result is
+    verified before it is renamed into place.
+
+    :return: bytes transferred by this call
+    """
+    destination = os.path.join(output, entry['path'])
+    if os.path.exists(destination):
+        try:
+            verify(destination, entry)
+            return 0
+        except ValueError as e:
+            print(">> " + str(e) + ", downloading again")
+            os.remove(destination)
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+
+    counter = counter or ByteCounter()
+    before = counter.value
+    url, params = resolve(session, entry, base_url)
+    size, ranged = probe(session, url, params)
+    size = entry.get('size', size)
+
+    if ranged and size:
+        count = max(1, min(segments, size // min_segment))
+        bounds = [(i * size // count, (i + 1) * size // count - 1) for i in range(count)]
+        parts = ['{}.part{}of{}'.format(destination, i, count) for i in range(count)]
+        with ThreadPoolExecutor(count) as pool:
+            jobs = [pool.submit(fetch_segment, session, url, params, part, start, end, counter)
+                    for part, (start, end) in zip(parts, bounds)]
+            for job in jobs:
+                job.result()
+    else:
+        parts = [destination + '.part0']
+        response = session.get(url, params=params, stream=True)
+        try:
+            response.raise_for_status()
+            save_response_content(response, parts[0], 'wb', counter)
+        finally:
+            response.close()
+
+    tmp = destination + '.tmp'
+    with open(tmp, 'wb') as f:
+        for part in parts:
+            with open(part, 'rb') as p:
+                for block in iter(lambda: p.read(BLOCK_SIZE), b''):
+                    f.write(block)
+    try:
+        verify(tmp, entry)
+    except ValueError:
+        # Start over next time instead of resuming corrupt parts
+        for name in parts + [tmp]:
+            os.remove(name)
+        raise
+    os.replace(tmp, destination)
+    for part in parts:
+        os.remove(part)
+    return counter.value - before
+
+
+def download_manifest(manifest, output, base_url=None, workers=4, segments=4, min_segment=MIN_SEGMENT):
+    """
+    Download every file of a manifest concurrently over one pooled session.
+
+    :param list manifest: Entries with 'path' and either 'url' or a Google Drive 'id', and
+        optionally the expected 'size' and 'sha256' / 'md5'
+    :param str output: Directory the paths are relative to
+    :param str base_url: Prefix of relative urls, e.g. a local test server
+    :param int workers: Files downloaded at once
+    :param int segments: Parallel Range requests per file
+    :param int min_segment: Smallest segment in bytes
+    :return: report with bytes, seconds, throughput and failures
+    """
+    session = make_session(workers * segments)
+    counter = ByteCounter()
+    failures = {}
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(workers) as pool:
+        jobs = {pool.submit(download_file, session, entry, output, base_url, segments, min_segment, counter): entry['path']
+                for entry in manifest}
+        for job, path in jobs.items():
+            try:
+                job.result()
+                print(">> " + path + " ok")
+            except Exception as e:
+                failures[path] = str(e)
+                print(">> " + path + " failed: " + str(e))
+
+    seconds = time.perf_counter() - start
+    return {
+        'files': len(manifest),
+        'failed': failures,
+        'bytes': counter.value,
+        'seconds': seconds,
+        'mb_per_second': counter.value / 1e6 / seconds if seconds else 0.0
+    }
+
+
+# Download the files listed in a manifest
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel, resumable, verified dataset download')
+    parser.add_argument('manifest', help='JSON list of {path, url | id, size, sha256}')
+    parser.add_argument('--output', default='./')
+    parser.add_argument('--base-url', help='prefix of relative manifest urls')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=4, help='parallel range requests per file')
+    parser.add_argument('--min-segment', type=int, default=MIN_SEGMENT >> 20, help='smallest segment in MB')
+    args = parser.parse_args()
+
+    with open(args.manifest, 'r') as f:
+        manifest = json.load(f)
+    report = download_manifest(manifest, args.output, args.base_url, args.workers, args.segments, args.min_segment << 20)
+    print(">> {} bytes in {:.1f} s, {:.2f} MB/s".format(report['bytes'], report['seconds'], report['mb_per_second']))
+    if report['failed']:
+        raise SystemExit('{} of {} files failed'.format(len(report['failed']), report['files']))
@@ -0,0 +1,278 @@
+import os
+import json
+import uuid
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+import cv2
+import h5py
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from utility.h5data import h5DataCreate, h5DataAppend, h5DataCompact
+
+DATA_FORMAT = ".bmp"
+SCALE = 4
+SIZE_PATCH = 64
+SIZE_CONV = 6
+BLOCK_STEP = 16
+INTERPOLATION = cv2.INTER_CUBIC
+
+
+def loadY(name, scale=SCALE, interpolation=INTERPOLATION):
+    """Read an image and return its Y channel and the bicubic down/up-scaled copy of it"""
+    img = cv2.imread(name, cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError("could not read " + name)
+    return imageY(img, scale, interpolation)
+
+
+def imageY(img, scale=SCALE, interpolation=INTERPOLATION):
+    """Y channel of a BGR image and the bicubic down/up-scaled copy of it"""
+    hr_img = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0]
+    shape = hr_img.shape
+
+    lr_img = cv2.resize(hr_img, (int(shape[1] / scale), int(shape[0] / scale)), interpolation=interpolation)
+    lr_img = cv2.resize(lr_img, (shape[1], shape[0]), interpolation=interpolation)
+    return hr_img, lr_img
+
+
+def stridedPatches(img, size, step):
+    """All size x size patches of img taken every step pixels, as a (n, size, size, ...) array"""
+    rows = (img.shape[0] - size) // step + 1
+    cols = (img.shape[1] - size) // step + 1
+    if rows <= 0 or cols <= 0:
+        return np.empty((0, size, size) + img.shape[2:], dtype=img.dtype)
+    view = as_strided(img, shape=(rows, cols, size, size) + img.shape[2:],
+                      strides=(img.strides[0] * step, img.strides[1] * step) + img.strides, writeable=False)
+    return view.reshape((rows * cols, size, size) + img.shape[2:])
+
+
+def randomPatches(img, size, count, rng):
+    """count random size x size patches of img, gathered with one fancy index"""
+    if img.shape[0] < size or img.shape[1] < size:
+        return np.empty((0, size, size) + img.shape[2:], dtype=img.dtype)
+    ys = rng.randint(0, img.shape[0] - size + 1, count)
+    xs = rng.randint(0, img.shape[1] - size + 1, count)
+    window = np.arange(size)
+    return img[(ys[:, None] + window)[:, :, None], (xs[:, None] + window)[:, None, :]]
+
+
+def patchPairs(hr_img, lr_img, size=SIZE_PATCH, conv=SIZE_CONV, step=BLOCK_STEP, crop=None, rng=None):
+    """
+    Cut matching network input / label patches out of one image.
+
+    :param numpy.ndarray hr_img: High-resolution Y channel
+    :param numpy.ndarray lr_img: Bicubic down/up-scaled Y channel
+    :param int size: Input patch size
+    :param int conv: Pixels removed per side from the label by the valid convolutions
+    :param int step: Stride of a dense grid of patches, used when crop is None
+    :param int crop: Number of random patches per image
+    :param rng: numpy RandomState used for random crops
+    :return: data (n, size, size, 1) and label (n, size - 2 * conv, size - 2 * conv, 1), float32 in [0, 1]
+    """
+
+    # Stack both images so the same positions are cut from each in one pass
+    pair = np.stack((lr_img, hr_img), axis=-1)
+    if crop is None:
+        patches = stridedPatches(pair, size, step)
+    else:
+        patches = randomPatches(pair, size, crop, rng or np.random)
+
+    data = patches[:, :, :, 0:1].astype(np.float32)
+    data *= 1. / 255.
+    label = patches[:, conv:size - conv, conv:size - conv, 1:2].astype(np.float32)
+    label *= 1. / 255.
+    return data, label
+
+
+def parseImage(args):
+    """Pool worker: load one image and return its patches"""
+    name, seed, params = args
+    hr_img, lr_img = loadY(name, params['scale'])
+    rng = np.random.RandomState(seed)
+    return patchPairs(hr_img, lr_img, params['size'], params['conv'], params['step'], params['crop'], rng)
+
+
+def listImages(path, dataFormat=DATA_FORMAT):
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if dataFormat in name]
+
+
+def buildDataset(path, output_filename, scale=SCALE, size=SIZE_PATCH, conv=SIZE_CONV, step=BLOCK_STEP, crop=None,
+                 dataFormat=DATA_FORMAT, workers=None, seed=0, chunkSize=64, compression=None):
+    """
+    Build an SRCNN training file from a folder of images.
+
+    Images are spread across a process pool and their patches are appended to resizable
+    channels-last datasets as they arrive, so memory holds only a few images' patches.
+
+    :param str path: Folder with the source images
+    :param str output_filename: h5 file to write
+    :param int scale: Down-scaling factor used to make the network input
+    :param int size: Input patch size
+    :param int conv: Border removed from the labels by the valid convolutions
+    :param int step: Stride of the dense patch grid (parseCropData)
+    :param int crop: Random patches per image instead of a grid (parseData)
+    :param str dataFormat: Only files containing this string are used
+    :param int workers: Size of the process pool, defaults to the number of cores
+    :param int seed: Seed for the random crops; image i uses seed + i
+    :param int chunkSize: Rows per h5 chunk
+    :param str compression: h5py compression filter, e.g. 'gzip' or 'lzf'
+    :return: number of patches written
+    """
+    names = listImages(path, dataFormat)
+    params = {'scale': scale, 'size': size, 'conv': conv, 'step': step, 'crop': crop}
+    label_size = size - 2 * conv
+
+    with h5DataCreate(output_filename, (size, size, 1), (label_size, label_size, 1), chunkSize, compression) as h:
+        with Pool(workers) as pool:
+            for data, label in pool.imap(parseImage, [(name, seed + i, params) for i, name in enumerate(names)]):
+                h5DataAppend(h, data, label)
+        return h['data'].shape[0]
+
+
+def fileHash(name):
+    digest = hashlib.sha256()
+    with open(name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hashSeed(digest, seed=0):
+    """Random crop seed of an image, fixed by its content rather than its position in the folder"""
+    return (int(digest[:8], 16) + seed) % (2 ** 32)
+
+
+def readManifest(manifest_filename):
+    try:
+        with open(manifest_filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def writeManifest(manifest, manifest_filename):
+    with open(manifest_filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_filename + '.tmp', manifest_filename)
+
+
+def updateDataset(path, output_filename, scale=SCALE, size=SIZE_PATCH, conv=SIZE_CONV, step=BLOCK_STEP, crop=None,
+                  dataFormat=DATA_FORMAT, workers=None, seed=0, chunkSize=64, compression=None):
+    """
+    Bring an SRCNN training file up to date with a folder of images.
+
+    A manifest next to the h5 file (<output_filename>.manifest.json) records the build
+    parameters and, for every image, its content hash and the rows of its patches.
+    Only new or changed images are parsed and appended; the rows of changed and deleted
+    images are dropped by compacting the datasets in place. Random crops are seeded from
+    the image hash, so an image yields the same patches whichever run parses it. The file
+    is rebuilt from scratch when the parameters change or the manifest does not match it.
+
+    Before any row is touched, a new generation ID is written to the file's attributes;
+    the manifest records the same ID once the update completes. An interrupted update
+    leaves the two different, and the next run rebuilds instead of trusting stale rows.
+
+    Arguments are as for buildDataset.
+
+    :return: (patches in the file, images parsed, images dropped)
+    """
+    manifest_filename = output_filename + '.manifest.json'
+    params = {'scale': scale, 'size': size, 'conv': conv, 'step': step, 'crop': crop,
+              'dataFormat': dataFormat, 'seed': seed}
+    label_size = size - 2 * conv
+
+    manifest = readManifest(manifest_filename)
+    files = {}
+    h = None
+    if manifest is not None and manifest['params'] == params and os.path.exists(output_filename):
+        h = h5py.File(output_filename, 'a')
+        files = manifest['files']
+        generation = h.attrs.get('generation')
+        generation = generation.decode() if isinstance(generation, bytes) else generation
+        if (generation != manifest.get('generation')
+                or h['data'].shape[0] != sum(entry['count'] for entry in files.values())):
+            # Interrupted update: the rows no longer match the manifest
+            h.close()
+            h = None
+            files = {}
+    if h is None:
+        h = h5DataCreate(output_filename, (size, size, 1), (label_size, label_size, 1), chunkSize, compression)
+        files = {}
+    generation = h.attrs.get('generation')
+
+    def touch():
+        # Mark the file as being modified before its rows change
+        if h.attrs.get('generation') == generation:
+            h.attrs['generation'] = uuid.uuid4().hex
+            h.flush()
+
+    with h:
+        # Size and mtime unchanged means content unchanged; anything else is hashed again
+        current = {}
+        for name in listImages(path, dataFormat):
+            key = os.path.basename(name)
+            st = os.stat(name)
+            entry = files.get(key)
+            if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                current[key] = entry['hash']
+            else:
+                current[key] = fileHash(name)
+
+        stale = [key for key, entry in files.items() if current.get(key) != entry['hash']]
+        if stale:
+            touch()
+            kept = sorted((entry['start'], entry['start'] + entry['count'], key)
+                          for key, entry in files.items() if key not in stale)
+            starts = h5DataCompact(h, [(start, end) for start, end, _ in kept])
+            for key in stale:
+                del files[key]
+            for start, (_, _, key) in zip(starts, kept):
+                files[key]['start'] = start
+
+        added = sorted(key for key in current if key not in files)
+        if added:
+            touch()
+            jobs = [(os.path.join(path, key), hashSeed(current[key], seed), params) for key in added]
+            with Pool(workers) as pool:
+                for key, (data, label) in zip(added, pool.imap(parseImage, jobs)):
+                    start, end = h5DataAppend(h, data, label)
+                    st = os.stat(os.path.join(path, key))
+                    files[key] = {'hash': current[key], 'size': st.st_size, 'mtime': st.st_mtime,
+                                  'start': start, 'count': end - start}
+        total = h['data'].shape[0]
+        generation = h.attrs.get('generation')
+        generation = generation.decode() if isinstance(generation, bytes) else generation
+
+    writeManifest({'params': params, 'files': files, 'generation': generation}, manifest_filename)
+    return total, len(added), len(stale)
+
+
+# Build the SRCNN train / validate datasets
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build SRCNN h5 training data from a folder of images')
+    parser.add_argument('path')
+    parser.add_argument('output')
+    parser.add_argument('--scale', type=int, default=SCALE)
+    parser.add_argument('--size', type=int, default=SIZE_PATCH)
+    parser.add_argument('--conv', type=int, default=SIZE_CONV)
+    parser.add_argument('--step', type=int, default=BLOCK_STEP)
+    parser.add_argument('--crop', type=int, default=None, help='random patches per image instead of a grid')
+    parser.add_argument('--format', default=DATA_FORMAT)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compression', default=None)
+    parser.add_argument('--incremental', action='store_true', help='only parse new or changed images, see updateDataset')
+    args = parser.parse_args()
+
+    if args.incremental:
+        count, parsed, dropped = updateDataset(args.path, args.output, args.scale, args.size, args.conv, args.step,
+                                               args.crop, args.format, args.workers, args.seed, compression=args.compression)
+        print(args.output + " updated, " + str(count) + " patches, " + str(parsed) + " images parsed, "
+              + str(dropped) + " dropped")
+    else:
+        count = buildDataset(args.path, args.output, args.scale, args.size, args.conv, args.step, args.crop,
+                             args.format, args.workers, args.seed, compression=args.compression)
+        print(args.output + " generated, " + str(count) + " patches")
@@ -3,16 +3,83 @@ import numpy as np
 
 def h5DataRead(file):
   with h5py.File(file, 'r') as hf:
-    data = np.array(hf.get('data'))
-    label = np.array(hf.get('label'))
+    data = hf['data'][()]
+    label = hf['label'][()]
+    if h5DataLayout(hf) == 'channels_last':
+      return data, label
     train_data = np.transpose(data, (0, 2, 3, 1))
     train_label = np.transpose(label, (0, 2, 3, 1))
     return train_data, train_label
 
-def h5DataWrite(data, labels, output_filename):
+def h5DataLayout(hf):
+  # files written before the layout attribute existed are channels first
+  layout = hf.attrs.get('layout', 'channels_first')
+  return layout.decode() if isinstance(layout, bytes) else layout
+
+def h5DataWrite(data, labels, output_filename, layout='channels_first', chunkSize=None, compression=None):
+  # data and labels are given channels first, (N, 1, H, W), as built by the parse notebooks
   x = data.astype(np.float32)
   y = labels.astype(np.float32)
+  if layout == 'channels_last':
+    x = np.transpose(x, (0, 2, 3, 1))
+    y = np.transpose(y, (0, 2, 3, 1))
 
   with h5py.File(output_filename, 'w') as h:
-    h.create_dataset('data', data=x, shape=x.shape)
-    h.create_dataset('label', data=y, shape=y.shape)
\ No newline at end of file
+    h.attrs['layout'] = layout
+    h.create_dataset('data', data=x, shape=x.shape, chunks=h5DataChunks(x.shape, chunkSize), compression=compression)
+    h.create_dataset('label', data=y, shape=y.shape, chunks=h5DataChunks(y.shape, chunkSize), compression=compression)
+
+def h5DataChunks(shape, chunkSize):
+  if chunkSize is None:
+    return None
+  return (min(chunkSize, max(shape[0], 1)),) + tuple(shape[1:])
+
+def h5DataCreate(output_filename, dataShape, labelShape, chunkSize=64, compression=None):
+  # empty, resizable channels last datasets to be filled with h5DataAppend
+  h = h5py.File(output_filename, 'w')
+  h.attrs['layout'] = 'channels_last'
+  for name, shape in (('data', tuple(dataShape)), ('label', tuple(labelShape))):
+    h.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, chunks=(chunkSize,) + shape,
+                     dtype=np.float32, compression=compression)
+  return h
+
+def h5DataCheckAppend(h, dataShape, labelShape):
+  # raise ValueError unless h holds channels last datasets of these sample shapes that h5DataAppend can grow
+  if h5DataLayout(h) != 'channels_last':
+    raise ValueError('{}: datasets are {}, appending needs channels_last'.format(h.filename, h5DataLayout(h)))
+  for name, shape in (('data', tuple(dataShape)), ('label', tuple(labelShape))):
+    if name not in h:
+      raise ValueError('{}: no {} dataset'.format(h.filename, name))
+    dataset = h[name]
+    if dataset.shape[1:] != shape:
+      raise ValueError('{}: {} samples are {}, expected {}'.format(h.filename, name, dataset.shape[1:], shape))
+    if dataset.maxshape[0] is not None:
+      raise ValueError('{}: {} is not resizable; create the file with h5DataCreate'.format(h.filename, name))
+
+def h5DataAppend(h, data, labels):
+  start = h['data'].shape[0]
+  end = start + data.shape[0]
+  h['data'].resize(end, axis=0)
+  h['label'].resize(end, axis=0)
+  h['data'][start:end] = data
+  h['label'][start:end] = labels
+  return start, end
+
+def h5DataCompact(h, keep, blockRows=1024):
+  # keep the row ranges [(start, end), ...] (sorted, disjoint) of resizable datasets, moving
+  # them down over the dropped rows in place; returns the new start of every range
+  starts = []
+  write = 0
+  for start, end in keep:
+    starts.append(write)
+    if start != write:
+      for s in range(start, end, blockRows):
+        e = min(s + blockRows, end)
+        h['data'][write:write + e - s] = h['data'][s:e]
+        h['label'][write:write + e - s] = h['label'][s:e]
+        write += e - s
+    else:
+      write = end
+  h['data'].resize(write, axis=0)
+  h['label'].resize(write, axis=0)
+  return starts
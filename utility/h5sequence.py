@@ -0,0 +1,148 @@
+import os
+import threading
+import queue
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+from keras.utils import Sequence
+
+from utility.h5data import h5DataLayout
+
+
+class H5DataSequence(Sequence):
+    """
+    Lazily stream the data/label datasets of an SRCNN h5 file into model.fit_generator.
+
+    Samples are shuffled inside windows of whole chunks so every read is a contiguous
+    slice of the file. At most cacheChunks chunks are held in memory, and a background
+    thread reads the chunks of the next batches while the current one trains.
+    """
+
+    def __init__(self, file, batchSize=128, shuffle=True, chunkRows=1024, cacheChunks=8, prefetch=2, seed=None, transform=None):
+        """
+        :param str file: Path of the h5 file written by h5DataWrite
+        :param int batchSize: Samples per batch
+        :param bool shuffle: Reshuffle the samples at the end of every epoch
+        :param int chunkRows: Rows per read, rounded down to whole chunks of chunked datasets
+        :param int cacheChunks: Upper bound on chunks held in memory
+        :param int prefetch: How many batches ahead to read
+        :param int seed: Seed of the shuffling, for reproducible runs
+        :param transform: Optional function mapping the (data, label) of each batch to the pair
+                          to train on, e.g. srcnn_subpixel.prepare
+        """
+        self.file = file
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.cacheChunks = cacheChunks
+        self.prefetch = prefetch
+        self.transform = transform
+        self.rng = np.random.RandomState(seed)
+
+        with h5py.File(file, 'r') as hf:
+            self.samples = hf['data'].shape[0]
+            chunks = hf['data'].chunks
+            self.channelsFirst = h5DataLayout(hf) != 'channels_last'
+        # Read whole chunks, several at a time when the file uses small ones
+        self.chunkRows = chunks[0] * max(1, chunkRows // chunks[0]) if chunks else chunkRows
+        self.chunkCount = (self.samples + self.chunkRows - 1) // self.chunkRows
+
+        # Shuffle window: half the cache, so the next window can be read ahead
+        self.windowChunks = max(1, cacheChunks // 2)
+
+        self.hf = None
+        self.pid = None
+        self.cache = OrderedDict()
+        self.cacheLock = threading.Lock()
+        self.readLock = threading.Lock()
+        # Read-ahead never runs further than the cache can hold
+        self.pending = queue.Queue(cacheChunks)
+        self.worker = None
+
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (self.samples + self.batchSize - 1) // self.batchSize
+
+    def on_epoch_end(self):
+        """Shuffle the chunk order, then the samples inside each window of chunks"""
+        if not self.shuffle:
+            self.order = np.arange(self.samples)
+            return
+
+        order = []
+        chunks = self.rng.permutation(self.chunkCount)
+        for start in range(0, self.chunkCount, self.windowChunks):
+            window = np.concatenate([np.arange(c * self.chunkRows, min((c + 1) * self.chunkRows, self.samples))
+                                     for c in chunks[start:start + self.windowChunks]])
+            order.append(self.rng.permutation(window))
+        self.order = np.concatenate(order)
+
+    def open(self):
+        # h5py handles can not cross a fork, so each worker process opens its own
+        if self.hf is None or self.pid != os.getpid():
+            self.hf = h5py.File(self.file, 'r')
+            self.pid = os.getpid()
+            self.cache = OrderedDict()
+        return self.hf
+
+    def readChunk(self, chunk):
+        with self.cacheLock:
+            if chunk in self.cache:
+                self.cache.move_to_end(chunk)
+                return self.cache[chunk]
+
+        with self.readLock:
+            hf = self.open()
+            rows = slice(chunk * self.chunkRows, min((chunk + 1) * self.chunkRows, self.samples))
+            block = (hf['data'][rows], hf['label'][rows])
+
+        with self.cacheLock:
+            self.cache[chunk] = block
+            while len(self.cache) > self.cacheChunks:
+                self.cache.popitem(last=False)
+        return block
+
+    def batchIndices(self, idx):
+        return self.order[idx * self.batchSize:(idx + 1) * self.batchSize]
+
+    def prefetchLoop(self):
+        while True:
+            self.readChunk(self.pending.get())
+
+    def schedule(self, idx):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.prefetchLoop, daemon=True)
+            self.worker.start()
+        for ahead in range(idx + 1, min(idx + 1 + self.prefetch, len(self))):
+            for chunk in np.unique(self.batchIndices(ahead) // self.chunkRows):
+                if chunk not in self.cache:
+                    try:
+                        self.pending.put_nowait(chunk)
+                    except queue.Full:
+                        # A slow consumer: leave the rest to be read when the batch is needed
+                        return
+
+    def __getitem__(self, idx):
+        indices = self.batchIndices(idx)
+        chunks = indices // self.chunkRows
+        offsets = indices % self.chunkRows
+
+        first = self.readChunk(chunks[0])
+        data = np.empty((len(indices),) + first[0].shape[1:], dtype=np.float32)
+        label = np.empty((len(indices),) + first[1].shape[1:], dtype=np.float32)
+        for chunk in np.unique(chunks):
+            block = self.readChunk(chunk)
+            mask = chunks == chunk
+            data[mask] = block[0][offsets[mask]]
+            label[mask] = block[1][offsets[mask]]
+
+        if self.prefetch:
+            self.schedule(idx)
+
+        if self.channelsFirst:
+            data = np.transpose(data, (0, 2, 3, 1))
+            label = np.transpose(label, (0, 2, 3, 1))
+        if self.transform is not None:
+            data, label = self.transform(data, label)
+        return data, label
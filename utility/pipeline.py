@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import bisect
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+SIZE_CONV = 6
+INTERPOLATION = cv2.INTER_CUBIC
+
+# Upper bounds (ms) of the latency histogram buckets
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class Profiler():
+    """
+    Per-stage timing and memory instrumentation.
+
+    Every stage gets a call counter, total / min / max time and a latency histogram.
+    With memory=True, numpy and Python allocations are followed through tracemalloc
+    and the peak extra memory of each stage is recorded. With trace=True every call is
+    kept as a Chrome trace event (open the file in chrome://tracing or Perfetto).
+    """
+
+    def __init__(self, memory=False, trace=False):
+        """
+        :param bool memory: Record the peak allocation of every stage (slows the pipeline down)
+        :param bool trace: Keep an event per stage call for write_trace
+        """
+        self.memory = memory
+        self.trace = trace
+        self.stats = {}
+        self.counters = {}
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one call of stage name"""
+        if self.memory:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            peak = tracemalloc.get_traced_memory()[1] - before if self.memory else None
+            self.record(name, start, end, peak)
+
+    def record(self, name, start, end, peak=None):
+        ms = (end - start) * 1000
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {'count': 0, 'total_ms': 0.0, 'min_ms': ms, 'max_ms': ms,
+                                           'histogram': [0] * (len(BUCKETS_MS) + 1), 'peak_bytes': 0}
+            stat['count'] += 1
+            stat['total_ms'] += ms
+            stat['min_ms'] = min(stat['min_ms'], ms)
+            stat['max_ms'] = max(stat['max_ms'], ms)
+            stat['histogram'][bisect.bisect_left(BUCKETS_MS, ms)] += 1
+            if peak is not None:
+                stat['peak_bytes'] = max(stat['peak_bytes'], peak)
+            if self.trace:
+                self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Per-stage statistics, with each stage's share of the total time"""
+        with self.lock:
+            total = sum(stat['total_ms'] for stat in self.stats.values()) or 1.0
+            stages = {}
+            for name, stat in self.stats.items():
+                stage = dict(stat)
+                stage['mean_ms'] = stat['total_ms'] / stat['count']
+                stage['share'] = stat['total_ms'] / total
+                stage['histogram'] = {('<=' + str(bound)): n for bound, n in zip(BUCKETS_MS, stat['histogram'])}
+                stage['histogram']['>' + str(BUCKETS_MS[-1])] = stat['histogram'][-1]
+                if not self.memory:
+                    del stage['peak_bytes']
+                stages[name] = stage
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def report(self):
+        """Print one line per stage, slowest first"""
+        stages = self.summary()['stages']
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]['total_ms']):
+            line = "{:<16} {:>6} calls {:>10.2f} ms total {:>8.3f} ms mean {:>6.1%}".format(
+                name, stage['count'], stage['total_ms'], stage['mean_ms'], stage['share'])
+            if 'peak_bytes' in stage:
+                line += " {:>8.1f} MB peak".format(stage['peak_bytes'] / 1e6)
+            print(line)
+
+    def write_trace(self, path):
+        with self.lock:
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Pipeline():
+    """
+    A fixed sequence of named stages; each stage gets the output of the previous one.
+
+    Stages are timed through the profiler, so the cost of file I/O, colour conversion
+    and the network itself can be compared on the same run.
+    """
+
+    def __init__(self, stages, profiler=None):
+        """
+        :param list stages: (name, function) pairs
+        :param Profiler profiler: instrumentation shared by all runs. A plain timing profiler if None
+        """
+        self.stages = stages
+        self.profiler = profiler or Profiler()
+
+    def run(self, value):
+        for name, stage in self.stages:
+            with self.profiler.stage(name):
+                value = stage(value)
+        self.profiler.count('runs')
+        return value
+
+
+def srcnnPipeline(model, scale, profiler=None, sizeConv=SIZE_CONV, interpolation=INTERPOLATION):
+    """
+    The inference flow of the srcnn_inference notebooks as a Pipeline.
+
+    run() takes (input_name, output_name) and returns the written BGR image.
+
+    :param model: SRCNN model or engine with a Keras-style predict method
+    :param int scale: Up-scaling factor
+    :param Profiler profiler: instrumentation to use
+    :param int sizeConv: Border lost to the valid convolutions
+    :param interpolation: OpenCV interpolation of the bicubic upscale
+    """
+
+    def imread(state):
+        name, output = state
+        return {'img': cv2.imread(name, cv2.IMREAD_COLOR), 'output': output}
+
+    def toYCrCb(state):
+        state['img'] = cv2.cvtColor(state['img'], cv2.COLOR_BGR2YCrCb)
+        return state
+
+    def resize(state):
+        shape = state['img'].shape
+        state['img'] = cv2.resize(state['img'], (shape[1] * scale, shape[0] * scale), interpolation=interpolation)
+        return state
+
+    def toFloat(state):
+        state['tensor'] = state['img'][None, :, :, 0:1].astype(np.float32) / 255.
+        return state
+
+    def predict(state):
+        state['tensor'] = model.predict(state['tensor'], batch_size=1)
+        return state
+
+    def clip(state):
+        state['tensor'] = np.clip(state['tensor'] * 255., 0, 255)
+        return state
+
+    def toUint8(state):
+        state['img'][sizeConv:-sizeConv, sizeConv:-sizeConv, 0] = state['tensor'][0, :, :, 0].astype(np.uint8)
+        return state
+
+    def toBGR(state):
+        state['img'] = cv2.cvtColor(state['img'], cv2.COLOR_YCrCb2BGR)
+        return state
+
+    def imwrite(state):
+        cv2.imwrite(state['output'], state['img'], [int(cv2.IMWRITE_PNG_COMPRESSION), 0])
+        return state['img']
+
+    return Pipeline([
+        ('imread', imread), ('bgr2ycrcb', toYCrCb), ('resize', resize), ('float', toFloat),
+        ('predict', predict), ('clip', clip), ('uint8', toUint8), ('ycrcb2bgr', toBGR), ('imwrite', imwrite)
+    ], profiler)
+
+
+def srganPipeline(generator, profiler=None):
+    """
+    The inference flow of the srgan_inference notebook as a Pipeline.
+
+    run() takes (input_name, output_name) and returns the written BGR image.
+    """
+
+    def imread(state):
+        name, output = state
+        return {'img': cv2.imread(name, cv2.IMREAD_COLOR), 'output': output}
+
+    def toRGB(state):
+        state['img'] = cv2.cvtColor(state['img'], cv2.COLOR_BGR2RGB)
+        return state
+
+    def toFloat(state):
+        state['tensor'] = state['img'][None].astype(np.float32) / 127.5 - 1
+        return state
+
+    def predict(state):
+        state['tensor'] = generator.predict(state['tensor'], batch_size=1)
+        return state
+
+    def clip(state):
+        state['tensor'] = np.clip(127.5 * state['tensor'][0] + 127.5, 0, 255)
+        return state
+
+    def toUint8(state):
+        state['img'] = state['tensor'].astype(np.uint8)
+        return state
+
+    def toBGR(state):
+        state['img'] = cv2.cvtColor(state['img'], cv2.COLOR_RGB2BGR)
+        return state
+
+    def imwrite(state):
+        cv2.imwrite(state['output'], state['img'], [int(cv2.IMWRITE_PNG_COMPRESSION), 0])
+        return state['img']
+
+    return Pipeline([
+        ('imread', imread), ('bgr2rgb', toRGB), ('float', toFloat), ('predict', predict),
+        ('clip', clip), ('uint8', toUint8), ('rgb2bgr', toBGR), ('imwrite', imwrite)
+    ], profiler)
+
+
+# Profile the SRCNN inference flow over a folder of images
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage profile of the SRCNN inference pipeline')
+    parser.add_argument('--network', default='./model/yayoi_srcnn_935_2x_network.json')
+    parser.add_argument('--weights', default='./model/yayoi_srcnn_935_2x_weight.h5')
+    parser.add_argument('--scale', type=int, default=2)
+    parser.add_argument('--images', default='./imageValidate2/')
+    parser.add_argument('--output', default='./result/')
+    parser.add_argument('--memory', action='store_true', help='record the peak allocation of every stage')
+    parser.add_argument('--trace', help='write a Chrome trace to this file')
+    args = parser.parse_args()
+
+    from network.srcnn_numpy import NumpySRCNN
+
+    profiler = Profiler(memory=args.memory, trace=args.trace is not None)
+    pipeline = srcnnPipeline(NumpySRCNN(args.network, args.weights), args.scale, profiler)
+    os.makedirs(args.output, exist_ok=True)
+    for name in sorted(os.listdir(args.images)):
+        pipeline.run((os.path.join(args.images, name), os.path.join(args.output, os.path.splitext(name)[0] + '.png')))
+
+    profiler.report()
+    if args.trace:
+        profiler.write_trace(args.trace)
+        print(args.trace + " saved")
@@ -0,0 +1,192 @@
+import os
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Rescan the cache directory after this many writes, so the size limit also accounts
+# for entries written by other processes
+RESCAN_WRITES = 64
+
+# Eviction trims the cache down to this fraction of its limit, so a full cache does not
+# rescan the directory on every write
+LOW_WATER = 0.9
+
+
+def modelIdentity(*paths):
+    """
+    Content hash of the files that make up a model (network json, weights, graph).
+
+    :param str paths: Model files
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def resultKey(img, model, scale, mode=''):
+    """
+    :param numpy.ndarray img: Input pixels, hashed together with their shape and dtype
+    :param str model: modelIdentity of the model
+    :param int scale: Up-scaling factor
+    :param str mode: Anything else that changes the output, e.g. 'tiled' or 'adaptive'
+    :return: hex key of the result
+    """
+    digest = hashlib.sha256()
+    digest.update('{}|{}|{}|{}|{}|'.format(img.shape, img.dtype.str, model, scale, mode).encode())
+    digest.update(img.tobytes() if img.flags.c_contiguous else img.copy().tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache():
+    """
+    Content-addressed cache of encoded upscale results on local disk.
+
+    Entries are files named by their key, written to a temporary file and renamed into
+    place, so concurrent readers never see a partial entry. Reads touch the file's mtime,
+    which makes the oldest mtime the least recently used entry. Eviction runs under an
+    exclusive flock of the cache directory, so only one process trims at a time.
+    """
+
+    def __init__(self, path, maxBytes=1 << 30, suffix='.png'):
+        """
+        :param str path: Cache directory, created if missing
+        :param int maxBytes: Size limit of all entries together
+        :param str suffix: File suffix of the stored encoding
+        """
+        self.path = path
+        self.maxBytes = maxBytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = None
+        self.writes = 0
+        self.added = 0
+        self.scans = 0
+        self.evicting = False
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """Encoded result of key, or None on a miss"""
+        name = self.entry(key)
+        data = None
+        try:
+            with open(name, 'rb') as f:
+                data = f.read()
+            os.utime(name)
+        except FileNotFoundError:
+            # Not stored, or evicted by another process between open and utime
+            pass
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store an encoded result and trim the cache back under maxBytes"""
+        name = self.entry(key)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, name)
+
+        # Only the accounting holds the lock; the directory walk would stall every get()
+        with self.lock:
+            self.writes += 1
+            self.added += len(data)
+            rescan = self.size is None or self.writes % RESCAN_WRITES == 0
+            if self.size is not None:
+                self.size += len(data)
+            trim = (rescan or self.size > self.maxBytes) and not self.evicting
+            if trim:
+                self.evicting = True
+        if trim:
+            try:
+                self.evict()
+            finally:
+                with self.lock:
+                    self.evicting = False
+
+    def cached(self, key, compute):
+        """Return the stored result of key, or compute, store and return it"""
+        data = self.get(key)
+        if data is None:
+            data = compute()
+            self.put(key, data)
+        return data
+
+    def entries(self):
+        """(mtime, size, name) of every entry"""
+        found = []
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if not file.endswith(self.suffix):
+                    continue
+                name = os.path.join(root, file)
+                try:
+                    st = os.stat(name)
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime, st.st_size, name))
+        return found
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is back under LOW_WATER of maxBytes.
+
+        Runs without self.lock, taking it only to read and update the counters.
+        """
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with self.lock:
+                    added = self.added
+                found = sorted(self.entries())
+                size = sum(entry[1] for entry in found)
+                target = self.maxBytes if size <= self.maxBytes else self.maxBytes * LOW_WATER
+                evicted = 0
+                for _, length, name in found:
+                    if size <= target:
+                        break
+                    try:
+                        os.remove(name)
+                        evicted += 1
+                    except FileNotFoundError:
+                        pass
+                    size -= length
+                with self.lock:
+                    self.scans += 1
+                    self.evictions += evicted
+                    # Count what other threads stored while the directory was being walked
+                    self.size = size + self.added - added
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'scans': self.scans,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes': self.size
+            }
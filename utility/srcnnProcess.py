@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+SIZE_CONV = 6
+INTERPOLATION = cv2.INTER_CUBIC
+
+
+class SrcnnProcessor():
+    """
+    Pre- and post-processing of the Y-channel SRCNN path on reused float32 buffers.
+
+    Every intermediate (YCrCb image, upscaled image, network input, denormalized output,
+    BGR result) lives in a buffer keyed by its shape and dtype, so a batch job over
+    images of a few recurring sizes stops allocating after the first of each. The
+    returned arrays are those buffers: copy them if they must outlive the next call.
+    """
+
+    def __init__(self, scale, sizeConv=SIZE_CONV, border='bicubic', interpolation=INTERPOLATION):
+        """
+        :param int scale: Up-scaling factor
+        :param int sizeConv: Width of the frame the valid convolutions do not predict
+        :param str border: How that frame is filled: 'bicubic' keeps the bicubic Y as the
+            notebooks do, 'edge' replicates the outermost predicted pixels
+        :param interpolation: OpenCV interpolation of the upscale
+        """
+        if border not in ('bicubic', 'edge'):
+            raise ValueError('border must be bicubic or edge')
+        self.scale = scale
+        self.sizeConv = sizeConv
+        self.border = border
+        self.interpolation = interpolation
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        key = (name, shape, np.dtype(dtype))
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def release(self):
+        """Drop all buffers, e.g. after a run of unusually large images"""
+        self.buffers.clear()
+
+    def preprocess(self, img, degrade=False):
+        """
+        :param numpy.ndarray img: BGR uint8 image
+        :param bool degrade: Down- then up-scale to the original size instead of upscaling,
+            to compare against the original as the notebooks' PSNR mode does
+        :return: (upscaled YCrCb uint8 image, (1, H, W, 1) float32 network input in [0, 1])
+        """
+        h, w = img.shape[:2]
+        ycc = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb, dst=self.buffer('ycc', img.shape, np.uint8))
+
+        if degrade:
+            size = (int(w / self.scale), int(h / self.scale))
+            small = cv2.resize(ycc, size, dst=self.buffer('small', (size[1], size[0], 3), np.uint8),
+                               interpolation=self.interpolation)
+            hr = cv2.resize(small, (w, h), dst=self.buffer('hr', (h, w, 3), np.uint8), interpolation=self.interpolation)
+        else:
+            h, w = h * self.scale, w * self.scale
+            hr = cv2.resize(ycc, (w, h), dst=self.buffer('hr', (h, w, 3), np.uint8), interpolation=self.interpolation)
+
+        tensor = self.buffer('tensor', (1, h, w, 1), np.float32)
+        np.multiply(hr[:, :, 0], np.float32(1 / 255.), out=tensor[0, :, :, 0])
+        return hr, tensor
+
+    def postprocess(self, hr, output):
+        """
+        Write the network output into the Y channel of hr and convert back to BGR.
+
+        :param numpy.ndarray hr: YCrCb image returned by preprocess; its Y channel is overwritten
+        :param numpy.ndarray output: (1, H - 2 * sizeConv, W - 2 * sizeConv, 1) network output
+        :return: BGR uint8 image
+        """
+        b = self.sizeConv
+        out = self.buffer('output', output.shape[1:3], np.float32)
+        # Denormalize and clip in place, then truncate to uint8 like astype does
+        np.multiply(output[0, :, :, 0], np.float32(255.), out=out)
+        np.clip(out, 0, 255, out=out)
+
+        y = hr[:, :, 0]
+        if b > 0:
+            np.copyto(y[b:-b, b:-b], out, casting='unsafe')
+            if self.border == 'edge':
+                y[:b, b:-b] = y[b:b + 1, b:-b]
+                y[-b:, b:-b] = y[-b - 1:-b, b:-b]
+                y[:, :b] = y[:, b:b + 1]
+                y[:, -b:] = y[:, -b - 1:-b]
+        else:
+            np.copyto(y, out, casting='unsafe')
+
+        return cv2.cvtColor(hr, cv2.COLOR_YCrCb2BGR, dst=self.buffer('bgr', hr.shape, np.uint8))
+
+    def process(self, model, img, degrade=False):
+        """Upscale a BGR image with an SRCNN model or engine with a Keras-style predict method"""
+        hr, tensor = self.preprocess(img, degrade)
+        return self.postprocess(hr, model.predict(tensor, batch_size=1))
@@ -0,0 +1,302 @@
+import time
+import queue
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+SIZE_CONV = 6
+INTERPOLATION = cv2.INTER_CUBIC
+
+# Marks the end of the stream in the stage queues
+END = None
+
+# How often a stage waiting on a queue checks whether the run was stopped
+POLL = 0.1
+
+
+class Stopped(Exception):
+    """Raised in a stage waiting on a queue after another stage failed"""
+
+
+class StageStats():
+    """
+    Time a pipeline stage spends working, starved (waiting on its input queue) and
+    blocked (waiting for room in its output queue). A stage that is often blocked has
+    a slower stage behind it; one that is often starved has a slower stage ahead.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def get(self, source, stop):
+        start = time.perf_counter()
+        try:
+            while True:
+                if stop.is_set():
+                    raise Stopped()
+                try:
+                    return source.get(timeout=POLL)
+                except queue.Empty:
+                    pass
+        finally:
+            self.starved += time.perf_counter() - start
+
+    def put(self, target, item, stop):
+        start = time.perf_counter()
+        try:
+            while True:
+                if stop.is_set():
+                    raise Stopped()
+                try:
+                    target.put(item, timeout=POLL)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            self.blocked += time.perf_counter() - start
+
+    def report(self, elapsed):
+        return {
+            'items': self.items,
+            'busy': self.busy / elapsed if elapsed else 0.0,
+            'starved': self.starved / elapsed if elapsed else 0.0,
+            'blocked': self.blocked / elapsed if elapsed else 0.0
+        }
+
+
+def openSource(source):
+    """Open a video file, or a capture device when source is a device number"""
+    return cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+
+
+def srcnnFrames(model, scale, sizeConv=SIZE_CONV, interpolation=INTERPOLATION):
+    """
+    Batch upscale function for an SRCNN model, working on the Y channel as the notebooks do.
+
+    :return: function mapping a list of BGR frames to a list of upscaled BGR frames
+    """
+
+    def upscale(frames):
+        h, w = frames[0].shape[:2]
+        hrs = [cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2YCrCb), (w * scale, h * scale), interpolation=interpolation)
+               for frame in frames]
+        tensor = np.empty((len(hrs), h * scale, w * scale, 1), dtype=np.float32)
+        for i, hr in enumerate(hrs):
+            np.multiply(hr[:, :, 0], np.float32(1 / 255.), out=tensor[i, :, :, 0])
+
+        out = model.predict(tensor, batch_size=len(hrs))
+        np.multiply(out, np.float32(255.), out=out)
+        np.clip(out, 0, 255, out=out)
+
+        b = sizeConv
+        for i, hr in enumerate(hrs):
+            np.copyto(hr[b:hr.shape[0] - b, b:hr.shape[1] - b, 0], out[i, :, :, 0], casting='unsafe')
+        return [cv2.cvtColor(hr, cv2.COLOR_YCrCb2BGR) for hr in hrs]
+
+    return upscale
+
+
+def srganFrames(generator):
+    """Batch upscale function for the SRGAN generator"""
+
+    def upscale(frames):
+        batch = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames]).astype(np.float32)
+        batch = batch / 127.5 - 1
+        out = np.clip(127.5 * generator.predict(batch, batch_size=len(frames)) + 127.5, 0, 255).astype(np.uint8)
+        return [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in out]
+
+    return upscale
+
+
+class VideoUpscaler():
+    """
+    Upscale a video file or live capture with decode, inference and encode overlapped.
+
+    A reader thread decodes frames, the inference stage upscales batches of them and a
+    writer thread encodes the results with cv2.VideoWriter. The stages are connected by
+    bounded queues, so a slow stage holds back the others instead of piling up frames.
+    """
+
+    def __init__(self, upscale, batch_size=4, queue_size=8, fourcc='mp4v'):
+        """
+        :param upscale: Function mapping a list of BGR frames to upscaled BGR frames, see srcnnFrames
+        :param int batch_size: Largest number of frames per model call
+        :param int queue_size: Capacity of each queue between stages, in batches
+        :param str fourcc: Codec of the output video
+        """
+        self.upscale = upscale
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.fourcc = fourcc
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.error = None
+
+    def fail(self, error):
+        """Record the first error of any stage and stop the others"""
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop.set()
+
+    def read(self, capture, frames, stats, max_frames):
+        try:
+            while not self.stop.is_set() and (max_frames is None or stats.items < max_frames):
+                start = time.perf_counter()
+                grabbed, frame = capture.read()
+                stats.busy += time.perf_counter() - start
+                if not grabbed:
+                    break
+                stats.items += 1
+                stats.put(frames, frame, self.stop)
+            stats.put(frames, END, self.stop)
+        except Stopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+    def infer(self, frames, results, stats):
+        """Group the frames waiting in the queue into batches and upscale them"""
+        try:
+            ended = False
+            while not ended:
+                frame = stats.get(frames, self.stop)
+                if frame is END:
+                    break
+                batch = [frame]
+                while len(batch) < self.batch_size:
+                    try:
+                        frame = frames.get_nowait()
+                    except queue.Empty:
+                        break
+                    if frame is END:
+                        ended = True
+                        break
+                    batch.append(frame)
+
+                start = time.perf_counter()
+                outputs = self.upscale(batch)
+                stats.busy += time.perf_counter() - start
+                stats.items += len(batch)
+                stats.put(results, outputs, self.stop)
+            stats.put(results, END, self.stop)
+        except Stopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+    def write(self, output, fps, results, stats):
+        writer = None
+        try:
+            while True:
+                outputs = stats.get(results, self.stop)
+                if outputs is END:
+                    break
+                start = time.perf_counter()
+                if writer is None:
+                    h, w = outputs[0].shape[:2]
+                    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*self.fourcc), fps, (w, h))
+                    if not writer.isOpened():
+                        raise IOError('Could not open {} for writing with codec {}'.format(output, self.fourcc))
+                for frame in outputs:
+                    writer.write(frame)
+                stats.busy += time.perf_counter() - start
+                stats.items += len(outputs)
+        except Stopped:
+            pass
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def run(self, source, output, max_frames=None):
+        """
+        Upscale source into output.
+
+        An error in any stage stops the other two and is raised here once they have
+        finished.
+
+        :param source: Video file name or capture device number
+        :param str output: Output video file
+        :param int max_frames: Stop after this many frames, e.g. for live captures
+        :return: fps and per-stage busy / starved / blocked fractions of the wall time
+        """
+        capture = openSource(source)
+        if not capture.isOpened():
+            raise IOError('Could not open ' + str(source))
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.
+
+        # Frames are queued one by one, results in batches
+        frames = queue.Queue(self.queue_size * self.batch_size)
+        results = queue.Queue(self.queue_size)
+        stages = [StageStats('read'), StageStats('infer'), StageStats('write')]
+
+        self.stop.clear()
+        self.error = None
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=self.read, args=(capture, frames, stages[0], max_frames), daemon=True),
+            threading.Thread(target=self.write, args=(output, fps, results, stages[2]), daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self.infer(frames, results, stages[1])
+        finally:
+            for thread in threads:
+                thread.join()
+            capture.release()
+            # Drop what a stopped run left behind in the queues
+            for pending in (frames, results):
+                while not pending.empty():
+                    pending.get_nowait()
+        if self.error is not None:
+            raise self.error
+        elapsed = time.perf_counter() - start
+
+        return {
+            'frames': stages[2].items,
+            'seconds': elapsed,
+            'fps': stages[2].items / elapsed if elapsed else 0.0,
+            'stages': {stage.name: stage.report(elapsed) for stage in stages}
+        }
+
+
+# Upscale a video file or capture device
+if __name__ == '__main__':
+    from utility.benchmark import MODELS, ENGINES, load_model
+
+    parser = argparse.ArgumentParser(description='Streaming video super-resolution')
+    parser.add_argument('source', help='video file, or capture device number')
+    parser.add_argument('output', help='output video file')
+    parser.add_argument('--model', default='srcnn_2x', choices=sorted(MODELS))
+    parser.add_argument('--engine', default='numpy', choices=sorted(set(sum(ENGINES.values(), ()))))
+    parser.add_argument('--model-path', default='./model/')
+    parser.add_argument('--variant', help='float16 / int8 weights from network.quantize, for --engine variant')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=8, help='batches buffered between stages')
+    parser.add_argument('--fourcc', default='mp4v')
+    parser.add_argument('--max-frames', type=int, help='stop after this many frames')
+    args = parser.parse_args()
+
+    if args.engine not in ENGINES[MODELS[args.model]['kind']]:
+        parser.error('{} can not run on --engine {}'.format(args.model, args.engine))
+    if args.engine == 'variant' and not args.variant:
+        parser.error('--engine variant needs --variant')
+
+    spec = MODELS[args.model]
+    model = load_model(args.model, args.engine, args.model_path, variant=args.variant)
+    upscale = srcnnFrames(model, spec['scale']) if spec['kind'] == 'srcnn' else srganFrames(model)
+
+    report = VideoUpscaler(upscale, args.batch_size, args.queue_size, args.fourcc).run(args.source, args.output, args.max_frames)
+    print(">> {} frames in {:.1f} s, {:.2f} fps".format(report['frames'], report['seconds'], report['fps']))
+    for name, stage in report['stages'].items():
+        print(">> {:<6} busy {:>6.1%} starved {:>6.1%} blocked {:>6.1%}".format(
+            name, stage['busy'], stage['starved'], stage['blocked']))